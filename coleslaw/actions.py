@@ -1,16 +1,23 @@
 """Main module."""
 
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
 import logging
 import logging.config
 import os.path
 import pprint
 import yaml
 
-import anytree
 import attr
 
+from . import checksums
 from . import config
+from . import models
 from . import readers
+from . import snapshot
+from . import utils
 from . import writers
 
 log = logging.getLogger(__name__)
@@ -34,35 +41,167 @@ def read_config(config_file_path):
     return config_info
 
 
-def build_tree(config_info, collection_filenames):
-    base_reader = readers.TreeReader()
-    base_node = base_reader.populate(config_info.app['output_dir'],
-                                     config_info.app['url_prefix'])
+def parallel_warehouses(config_info):
+    return config_info.app.get('parallel_warehouses') or 1
+
+
+def map_warehouses(config_info, func, *iterables):
+    '''map() func over the per warehouse args, on app.parallel_warehouses threads'''
+    jobs = parallel_warehouses(config_info)
+    if jobs <= 1:
+        return list(map(func, *iterables))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, *iterables))
+
+
+def lock_dir(config_info):
+    return config_info.app.get('lock_dir') or os.path.join(config_info.app['snapshot_dir'], 'locks')
+
+
+def output_lock_path(config_info, name):
+    '''The lock file for name in the output dir. Kept out of the output dir, since that is published.'''
+    output_key = hashlib.sha256(os.path.realpath(config_info.app['output_dir']).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(lock_dir(config_info), f'output-{output_key}-{name}.lock')
 
-    for warehouse_name, warehouse_info in config_info.warehouses.items():
-        warehouse_reader = readers.WarehouseTreeReader(warehouse_info, config_info)
-        collection_file_patterns = list(collection_filenames) + warehouse_info.collections
 
-        log.debug('updating collections for warehouse: %s', warehouse_info.warehouse_name)
+@contextlib.contextmanager
+def warehouse_locks(config_info):
+    '''Lock the snapshot and output of every configured warehouse, so overlapping runs take turns'''
+    with contextlib.ExitStack() as stack:
+        # always in the same order so runs with overlapping warehouses can not deadlock
+        for warehouse_name in sorted(config_info.warehouses):
+            stack.enter_context(utils.lock_file(os.path.join(config_info.app['snapshot_dir'],
+                                                             warehouse_name, '.lock')))
+            stack.enter_context(utils.lock_file(output_lock_path(config_info, warehouse_name)))
+        yield
 
-        r = anytree.Resolver("name")
-        content_path = "content/"
-        content_node = r.get(base_node, content_path)
 
-        wh_node = warehouse_reader.populate(parent_node=content_node)
-        wh_node = warehouse_reader.populate_collections(wh_node, collection_file_patterns)
+def finish_warehouse(config_info, warehouse_reader, wh_node, added_names_set, deleted_names_set, import_failures):
+    warehouse_info = warehouse_reader.warehouse_info
 
-        wh_export = writers.TreeExport(wh_node)
-        snapshot_dir = os.path.join(config_info.app['snapshot_dir'], warehouse_info.warehouse_name)
-        os.makedirs(snapshot_dir, exist_ok=True)
-        snapshot_path = os.path.join(snapshot_dir, "SNAPSHOT.json")
-        wh_export.snapshot(snapshot_path)
+    for import_failure in import_failures:
+        log.error('Skipping %s for warehouse %s: %s', import_failure.collection_path,
+                  warehouse_info.warehouse_name, import_failure.reason)
+
+    warehouse_reader.record_changes(wh_node,
+                                    added_names_set,
+                                    deleted_names_set,
+                                    import_failures)
+
+    wh_export = writers.TreeExport(wh_node)
+    snapshot_dir = warehouse_reader.snapshot_dir()
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot_path = os.path.join(snapshot_dir, "SNAPSHOT.json")
+    snapshot_sha256 = warehouse_reader.unchanged_snapshot_sha256(wh_node)
+    if snapshot_sha256 is None:
+        snapshot_sha256 = wh_export.snapshot(snapshot_path)
+    # written by export_tree(), once the output matches the snapshot
+    wh_node._excluded_export_stamp = (warehouse_reader.export_stamp_path(),
+                                      snapshot.export_stamp(wh_node, snapshot_sha256,
+                                                            warehouse_reader.template_fingerprints()))
+
+    # With parallel warehouses, each writes its own subtree here and export_tree() only
+    # does the root level aggregates.
+    if parallel_warehouses(config_info) > 1:
+        wh_export.export_now()
+
+    return wh_node
+
+
+def build_tree(config_info, collection_filenames):
+    # before the run, not once it is time to export
+    writers.check_app_config(config_info.app)
+
+    base_reader = readers.TreeReader()
+    base_node = base_reader.populate(config_info.app['output_dir'],
+                                     config_info.app['url_prefix'])
+    # shared by every SHA256SUMS in the tree, until export_tree() is done
+    base_node._excluded_checksum_engine = checksums.ChecksumEngine.from_app_config(config_info.app)
+
+    content_path = "content/"
+    content_node = base_node.get_path(content_path)
+
+    # Set up every warehouse first, so artifacts listed by more than one are only imported once
+    warehouse_readers = [readers.WarehouseTreeReader(warehouse_info, config_info)
+                         for warehouse_info in config_info.warehouses.values()]
+
+    # Attaching to content_node is not thread safe, so only the snapshot loading is concurrent
+    if parallel_warehouses(config_info) > 1:
+        map_warehouses(config_info, readers.WarehouseTreeReader.preload_snapshot, warehouse_readers)
+    wh_nodes = [warehouse_reader.populate(parent_node=content_node) for warehouse_reader in warehouse_readers]
+
+    def collections_to_import(warehouse_reader, wh_node):
+        collection_file_patterns = list(collection_filenames) + warehouse_reader.warehouse_info.collections
+        return warehouse_reader.collections_to_import(wh_node, collection_file_patterns)
+
+    to_import = map_warehouses(config_info, collections_to_import, warehouse_readers, wh_nodes)
+
+    warehouses = {}
+    import_requests = []
+    for warehouse_reader, wh_node, (added_collection_filenames, deleted_names_set) in zip(warehouse_readers, wh_nodes, to_import):
+        warehouse_info = warehouse_reader.warehouse_info
+        warehouses[warehouse_info.warehouse_name] = (warehouse_reader, wh_node, deleted_names_set)
+        import_requests.append((warehouse_info, added_collection_filenames))
+
+    # In pipelined mode, each collection version is written as soon as it is imported
+    # and only the aggregate indexes are left for export_tree()
+    pipelined = config_info.app.get('pipelined', False)
+    # In bounded memory mode, the manifest bytes of each version are dropped as soon as
+    # it is added, and read back from the artifact when written.
+    bounded_memory = config_info.app.get('bounded_memory', False)
+
+    added_names = collections.defaultdict(set)
+    import_failures = collections.defaultdict(list)
+    # the import pool is only started if something needs importing
+    import_results = readers.import_collections(import_requests, config_info.importer,
+                                                checksum_engine=base_node._excluded_checksum_engine)
+    for warehouse_name, import_result in import_results:
+        if isinstance(import_result, models.ImportFailure):
+            import_failures[warehouse_name].append(import_result)
+            continue
+
+        warehouse_reader, wh_node, _deleted_names_set = warehouses[warehouse_name]
+        new_nodes = warehouse_reader.add_collection(wh_node, import_result)
+        added_names[warehouse_name].add(import_result.artifact_info.filename)
+
+        if pipelined:
+            for new_node in new_nodes:
+                writers.TreeExport(new_node).export_now()
+        elif bounded_memory:
+            for new_node in new_nodes:
+                new_node.release()
+
+    def finish(warehouse_name):
+        warehouse_reader, wh_node, deleted_names_set = warehouses[warehouse_name]
+        return finish_warehouse(config_info, warehouse_reader, wh_node,
+                                added_names[warehouse_name],
+                                deleted_names_set,
+                                import_failures[warehouse_name])
+
+    map_warehouses(config_info, finish, list(warehouses))
 
-        # snapshot
-        # tree_exporter.snapshot(warehouse_name=warehouse_info.warehouse_name)
     return base_node
 
 
-def export_tree(base_node):
-    tree_exporter = writers.TreeExport(base_node)
-    tree_exporter.export()
+def export_tree(config_info, base_node):
+    with utils.lock_file(output_lock_path(config_info, 'export')):
+        tree_exporter = writers.TreeExport.from_app_config(base_node, config_info.app)
+        checksum_engine = getattr(base_node, '_excluded_checksum_engine', None)
+        try:
+            # its workers are started again when the aggregates need them, after any export
+            # workers are forked
+            if checksum_engine is not None:
+                checksum_engine.close()
+            tree_exporter.export()
+        finally:
+            if checksum_engine is not None:
+                checksum_engine.close()
+
+        # The next run only has to export what changed since this snapshot
+        for wh_node in base_node.find_warehouses():
+            export_stamp = getattr(wh_node, '_excluded_export_stamp', None)
+            if export_stamp is not None:
+                stamp_path, stamp = export_stamp
+                stamp['output_sha256sums'] = snapshot.output_sha256sums_sha256(wh_node)
+                snapshot.write_export_stamp(stamp_path, stamp)
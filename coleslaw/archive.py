@@ -0,0 +1,161 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tarfile
+
+from . import models
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'MANIFEST.json'
+
+# Top level files (README.md, LICENSE, MANIFEST.json, FILES.json, etc) are kept in
+# memory as they stream by. Anything bigger than this is only written to disk.
+MAX_CAPTURE_SIZE = 16 * 1024 * 1024
+
+# Parts of an artifact galaxy_importer only looks at when running ansible-test
+ANSIBLE_TEST_ONLY_PREFIXES = ('tests/',)
+
+
+class HashingReader:
+    '''File-like wrapper that sha256sums and counts the bytes read through it.'''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def drain(self, block_size=65536):
+        '''Read the rest of the file (tar end-of-archive padding, gzip trailer, etc) so the sum is complete.'''
+        for block in iter(lambda: self.read(block_size), b''):
+            pass
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def import_skip_prefixes(galaxy_importer_config):
+    '''Return the member path prefixes that do not need to be extracted for an import.'''
+    if galaxy_importer_config.get('run_ansible_test'):
+        return ()
+    return ANSIBLE_TEST_ONLY_PREFIXES
+
+
+def _is_safe_member(member, extract_dir):
+    if os.path.isabs(member.name) or '..' in member.name.split('/'):
+        return False
+
+    if member.issym():
+        link_target = os.path.normpath(os.path.join(extract_dir,
+                                                    os.path.dirname(member.name),
+                                                    member.linkname))
+        return link_target.startswith(os.path.abspath(extract_dir))
+
+    return member.isfile() or member.isdir()
+
+
+def _file_manifest_filename(b_manifest):
+    try:
+        return json.loads(b_manifest)['file_manifest_file']['name']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def artifact_info_from_stat(collection_path, sha256, stat_result):
+    return models.ArtifactInfo(filename=os.path.basename(collection_path),
+                               full_path=collection_path,
+                               sha256=sha256,
+                               mtime=datetime.datetime.utcfromtimestamp(stat_result.st_mtime).isoformat(),
+                               size=stat_result.st_size)
+
+
+def read_members(collection_path, names):
+    '''Read only the named top level files from an artifact, stopping once they have all been seen.
+
+    Returns a dict of member name -> bytes, without any names that are not in the artifact.'''
+    wanted = set(names)
+    members = {}
+    with tarfile.open(collection_path, mode='r|*') as pkg_tar:
+        for member in pkg_tar:
+            if member.name in wanted and member.isfile():
+                members[member.name] = pkg_tar.extractfile(member).read()
+                if len(members) == len(wanted):
+                    break
+    return members
+
+
+def read_artifact(collection_path, extract_dir=None, skip_prefixes=()):
+    '''Read a collection artifact in a single streaming pass.
+
+    The sha256sum of the artifact is computed from the same read as the
+    tar members. Top level files are kept in memory (so MANIFEST.json and
+    FILES.json never need to be read back from disk). If extract_dir is provided,
+    the rest of the members are written there, except MANIFEST.json, the file
+    manifest, and any member under skip_prefixes.
+
+    Returns a models.ArtifactContents.'''
+
+    members = {}
+    file_manifest_filename = None
+
+    if extract_dir is not None:
+        os.makedirs(extract_dir, exist_ok=True)
+
+    with open(collection_path, 'rb') as b_collection_fo:
+        hashing_fo = HashingReader(b_collection_fo)
+
+        with tarfile.open(fileobj=hashing_fo, mode='r|*') as pkg_tar:
+            for member in pkg_tar:
+                is_top_level_file = member.isfile() and '/' not in member.name.strip('/')
+
+                if is_top_level_file and member.size <= MAX_CAPTURE_SIZE:
+                    b_contents = pkg_tar.extractfile(member).read()
+                    members[member.name] = b_contents
+
+                    if member.name == MANIFEST_FILENAME:
+                        file_manifest_filename = _file_manifest_filename(b_contents)
+                        continue
+
+                    if member.name == file_manifest_filename or extract_dir is None:
+                        continue
+
+                    # Already consumed from the stream, so write out what we read
+                    with open(os.path.join(extract_dir, member.name), 'wb') as member_fo:
+                        member_fo.write(b_contents)
+                    continue
+
+                if extract_dir is None:
+                    continue
+
+                if member.name.startswith(tuple(skip_prefixes)):
+                    continue
+
+                if not _is_safe_member(member, extract_dir):
+                    log.warning('Not extracting %s from %s', member.name, collection_path)
+                    continue
+
+                pkg_tar.extract(member, extract_dir, set_attrs=False)
+
+        hashing_fo.drain()
+        stat_result = os.fstat(b_collection_fo.fileno())
+
+    b_manifest = members.get(MANIFEST_FILENAME)
+    if file_manifest_filename is None and b_manifest is not None:
+        file_manifest_filename = _file_manifest_filename(b_manifest)
+
+    artifact_info = artifact_info_from_stat(collection_path, hashing_fo.hexdigest(), stat_result)
+
+    return models.ArtifactContents(artifact_info=artifact_info,
+                                   b_manifest=b_manifest,
+                                   file_manifest_filename=file_manifest_filename,
+                                   b_file_manifest=members.get(file_manifest_filename),
+                                   members=members)
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import pickle
+import tempfile
+
+import galaxy_importer
+
+log = logging.getLogger(__name__)
+
+# 2GiB
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+# When evicting, remove entries until the cache is this fraction of max_size
+EVICT_TO_RATIO = 0.9
+
+
+def fingerprint(data):
+    '''Return a sha256 hexdigest of json serializable data, stable across dict ordering'''
+    b_data = json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(b_data).hexdigest()
+
+
+def import_config_fingerprint(warehouse_info):
+    '''Everything besides the artifact contents that changes the result of an import'''
+    return fingerprint({'galaxy_importer_config': warehouse_info.galaxy_importer_config,
+                        'import_mode': warehouse_info.import_mode,
+                        'galaxy_importer_version': getattr(galaxy_importer, '__version__', None),
+                        })
+
+
+def import_cache_key(artifact_sha256, warehouse_info):
+    return fingerprint({'artifact_sha256': artifact_sha256,
+                        'import_config': import_config_fingerprint(warehouse_info)})
+
+
+def stat_cache_key(path):
+    '''Key for looking up an artifacts sha256 without reading it, based on path, size and mtime'''
+    stat_result = os.stat(path)
+    return fingerprint({'path': str(path),
+                        'size': stat_result.st_size,
+                        'mtime_ns': stat_result.st_mtime_ns})
+
+
+class ContentCache:
+    '''Size bounded on disk cache of pickled objects, keyed by a hex digest.
+
+    Entries are written atomically so multiple processes can share a cache_dir.
+    Reading an entry updates its mtime, and evict() removes the least recently
+    used entries once the total size is over max_size.'''
+
+    suffix = '.pickle'
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size or DEFAULT_MAX_SIZE
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as cache_fo:
+                value = pickle.load(cache_fo)
+        except FileNotFoundError:
+            return default
+        except (EOFError, pickle.UnpicklingError, AttributeError, ImportError) as exc:
+            log.warning('Removing unreadable cache entry %s: %s', path, exc)
+            self.remove(key)
+            return default
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_fo:
+                pickle.dump(value, tmp_fo, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def remove(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        for dirpath, _dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(self.suffix):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat_result = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat_result.st_mtime, stat_result.st_size, path
+
+    def evict(self):
+        '''Remove least recently used entries until the cache is under max_size'''
+        entries = sorted(self._entries())
+        total_size = sum(entry[1] for entry in entries)
+        if total_size <= self.max_size:
+            return 0
+
+        target_size = self.max_size * EVICT_TO_RATIO
+        removed = 0
+        for _mtime, size, path in entries:
+            if total_size <= target_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            removed += 1
+
+        log.debug('Evicted %s entries from %s', removed, self.cache_dir)
+        return removed
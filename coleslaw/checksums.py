@@ -0,0 +1,90 @@
+import concurrent.futures
+import logging
+import os
+import threading
+
+from . import utils
+
+log = logging.getLogger(__name__)
+
+POOL_TYPES = ('thread', 'process')
+
+
+def _file_signature(path):
+    stat_result = os.stat(path)
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+
+
+class ChecksumEngine():
+    '''Hashes files for SHA256SUMS on a pool of threads or processes.
+
+    Sums are kept for the whole run, keyed by the real path of the file, so a file
+    listed in several SHA256SUMS is only read once unless it changes in between.'''
+
+    def __init__(self, workers=None, pool_type='thread'):
+        if pool_type not in POOL_TYPES:
+            raise ValueError(f'checksum_pool must be one of {POOL_TYPES}, not {pool_type!r}')
+        self.workers = workers or os.cpu_count()
+        self.pool_type = pool_type
+        self._executor = None
+        # real path -> (file signature, sha256)
+        self._sha256s = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_app_config(cls, app_config):
+        return cls(workers=app_config.get('checksum_workers'),
+                   pool_type=app_config.get('checksum_pool') or 'thread')
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                log.debug('starting %s checksum %s workers', self.workers, self.pool_type)
+                if self.pool_type == 'process':
+                    self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                           thread_name_prefix='checksum')
+            return self._executor
+
+    def sha256sums(self, paths):
+        '''Map each of paths to the sha256 of its file'''
+        res = {}
+        to_hash = {}
+        with self._lock:
+            for path in paths:
+                real_path = os.path.realpath(path)
+                signature = _file_signature(real_path)
+                cached = self._sha256s.get(real_path)
+                if cached and cached[0] == signature:
+                    res[path] = cached[1]
+                    continue
+                to_hash.setdefault(real_path, (signature, []))[1].append(path)
+
+        if not to_hash:
+            return res
+
+        log.debug('hashing %s files (%s already known)', len(to_hash), len(res))
+        real_paths = list(to_hash)
+        if self.workers > 1 and len(real_paths) > 1:
+            sha256s = self._get_executor().map(utils.sha256sum_from_path, real_paths)
+        else:
+            sha256s = map(utils.sha256sum_from_path, real_paths)
+
+        for real_path, sha256 in zip(real_paths, sha256s):
+            signature, paths_for_real_path = to_hash[real_path]
+            with self._lock:
+                self._sha256s[real_path] = (signature, sha256)
+            for path in paths_for_real_path:
+                res[path] = sha256
+        return res
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+# Used by nodes in trees that were not given an engine of their own
+default_engine = ChecksumEngine(workers=1)
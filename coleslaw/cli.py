@@ -40,10 +40,15 @@ log = logging.getLogger(__name__)
               help='Specify a config file to use (default is ./coleslaw.yml)',
               type=click.Path(file_okay=True, dir_okay=False, writable=False,
                               exists=False, resolve_path=True))
+@click.option('-j', '--jobs',
+              'jobs',
+              default=None,
+              help='Number of warehouses to build at the same time (default is app.parallel_warehouses or 1)',
+              type=click.IntRange(min=1))
 @click.argument('collection_filenames', type=click.Path(exists=True), nargs=-1)
 def main(args=None, output_dir=None, templates_dir=None,
          warehouse_name=None, server=None, url_prefix=None,
-         config_file_path=None,
+         config_file_path=None, jobs=None,
          collection_filenames=None):
     """Console script for coleslaw."""
 
@@ -56,10 +61,13 @@ def main(args=None, output_dir=None, templates_dir=None,
     log.debug('config_file_path: %s', config_file_path)
 
     config_info = actions.read_config(config_file_path)
+    if jobs:
+        config_info.app['parallel_warehouses'] = jobs
 
-    base_node = actions.build_tree(config_info, collection_filenames)
+    with actions.warehouse_locks(config_info):
+        base_node = actions.build_tree(config_info, collection_filenames)
 
-    actions.export_tree(base_node)
+        actions.export_tree(config_info, base_node)
 
     return 0
 
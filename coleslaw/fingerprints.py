@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import weakref
+
+import jinja2
+import jinja2.meta
+
+log = logging.getLogger(__name__)
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class TemplateFingerprints():
+    '''sha256 fingerprints of the templates a jinja env can load.
+
+    A templates fingerprint covers its own source and the source of every template
+    it extends, includes or imports, all the way down. A reference that is not a
+    plain string (ie, `{% include name_var %}`) could be any template, so it counts
+    as referencing all of them.'''
+
+    def __init__(self, jinja_env):
+        self.jinja_env = jinja_env
+        self._template_names = None
+        # template name -> sha256 of its source, or None if it can not be loaded
+        self._source_sha256s = {}
+        # template name -> the names it references directly
+        self._references = {}
+        self._fingerprints = {}
+
+    def template_names(self):
+        '''Every template the env can load, or () if its loader can not list them'''
+        if self._template_names is None:
+            try:
+                self._template_names = tuple(self.jinja_env.list_templates())
+            except TypeError:
+                log.debug('the loader of %s can not list its templates', self.jinja_env)
+                self._template_names = ()
+        return self._template_names
+
+    def _load(self, template_name):
+        try:
+            source, _filename, _uptodate = self.jinja_env.loader.get_source(self.jinja_env, template_name)
+        except (jinja2.TemplateNotFound, UnicodeDecodeError):
+            self._source_sha256s[template_name] = None
+            self._references[template_name] = ()
+            return
+
+        self._source_sha256s[template_name] = _sha256(source)
+        references = set()
+        try:
+            for reference in jinja2.meta.find_referenced_templates(self.jinja_env.parse(source)):
+                if reference is None:
+                    references.update(self.template_names())
+                else:
+                    references.add(reference)
+        except jinja2.TemplateSyntaxError:
+            # rendering it will fail, but its source is still part of the fingerprint
+            pass
+        references.discard(template_name)
+        self._references[template_name] = tuple(sorted(references))
+
+    def closure(self, template_name):
+        '''template_name and every template it references, directly or not'''
+        seen = set()
+        names = [template_name]
+        while names:
+            name = names.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            if name not in self._references:
+                self._load(name)
+            names.extend(self._references[name])
+        return sorted(seen)
+
+    def fingerprint(self, template_name):
+        try:
+            return self._fingerprints[template_name]
+        except KeyError:
+            pass
+        lines = [f'{self._source_sha256s[name]}  {name}' for name in self.closure(template_name)]
+        self._fingerprints[template_name] = _sha256('\n'.join(lines))
+        return self._fingerprints[template_name]
+
+    def fingerprints(self):
+        '''{template name: fingerprint} for every template the env can load'''
+        return dict((name, self.fingerprint(name)) for name in self.template_names())
+
+    def changed_templates(self, previous_fingerprints):
+        '''The names of the templates whose fingerprint is not the one in previous_fingerprints'''
+        fingerprints = self.fingerprints()
+        names = set(fingerprints) | set(previous_fingerprints)
+        return set(name for name in names if fingerprints.get(name) != previous_fingerprints.get(name))
+
+
+# Templates do not change during a run, so each env is only fingerprinted once
+_env_fingerprints = weakref.WeakKeyDictionary()
+
+
+def for_env(jinja_env):
+    '''The TemplateFingerprints for jinja_env'''
+    try:
+        return _env_fingerprints[jinja_env]
+    except KeyError:
+        _env_fingerprints[jinja_env] = TemplateFingerprints(jinja_env)
+        return _env_fingerprints[jinja_env]
@@ -65,11 +65,20 @@ def ignore_bytes_attr_ittr(k_v_iter):
         if attribute.startswith('b_') or isinstance(value, bytes):
             # log.debug('SKIPPING %s type(value): %s', attribute, type(value))
             continue
+        # runtime only state, same as BaseNode.asdict()
+        if attribute.startswith('_excluded'):
+            continue
         yield attribute, value
 
 
+def ignore_virtual_children(children):
+    # virtual children are built from their parents data, so they are not exported
+    return [child for child in children if not child.is_virtual]
+
+
 def json_exporter():
-    dict_exporter = DictExporter(attriter=ignore_bytes_attr_ittr)
+    dict_exporter = DictExporter(attriter=ignore_bytes_attr_ittr,
+                                 childiter=ignore_virtual_children)
     exporter = JsonExporter(dictexporter=dict_exporter,
                             indent=4,
                             # sort_keys=True,
@@ -1,45 +1,171 @@
+import json
 import logging
 import os
 
+import galaxy_importer
 from galaxy_importer.collection import CollectionLoader
 from galaxy_importer import exceptions as exc
+from galaxy_importer import loaders
 from galaxy_importer import schema
 
+from . import cache
+
 log = logging.getLogger(__name__)
 
+DOC_FRAGMENTS_PREFIX = 'plugins/doc_fragments/'
+
+
+def _ansible_version():
+    try:
+        import ansible.release
+    except ImportError:
+        return None
+    return ansible.release.__version__
+
+
+def parse_manifest(b_manifest, filename):
+    '''Parse the bytes of a MANIFEST.json into a galaxy_importer CollectionArtifactManifest'''
+    try:
+        return schema.CollectionArtifactManifest.parse(b_manifest.decode('utf-8'))
+    except ValueError as e:
+        error_msg = f'Error loading artifact manifest "MANIFEST.json" from {filename}: {str(e)}'
+        raise exc.ManifestValidationError(error_msg)
+
+
+def file_manifest_sha256s(b_file_manifest):
+    '''Map the file names in a FILES.json to their sha256 checksums'''
+    file_manifest = json.loads(b_file_manifest)
+    return dict((item['name'], item['chksum_sha256']) for item in file_manifest.get('files', [])
+                if item.get('ftype') == 'file' and item.get('chksum_type') == 'sha256')
+
+
+class CachingDocStringLoader(loaders.DocStringLoader):
+    '''DocStringLoader that caches the ansible-doc output per plugin.
+
+    Entries are keyed by the plugins sha256 from the collection file manifest, so
+    unchanged plugins in new versions of a collection reuse the existing docs and
+    ansible-doc is only run for new or changed plugins. Since docs can include
+    doc_fragments, the key also includes the sums of every file in plugins/doc_fragments/.'''
+
+    def __init__(self, path, fq_collection_name, cfg, logger=None,
+                 doc_cache=None, file_sha256s=None):
+        super().__init__(path, fq_collection_name, cfg, logger=logger)
+        self.doc_cache = doc_cache
+        self.file_sha256s = file_sha256s or {}
+
+        doc_fragment_sums = sorted((name, sha256) for name, sha256 in self.file_sha256s.items()
+                                   if name.startswith(DOC_FRAGMENTS_PREFIX))
+        self.context_fingerprint = cache.fingerprint({'doc_fragments': doc_fragment_sums,
+                                                      'galaxy_importer_version': getattr(galaxy_importer, '__version__', None),
+                                                      'ansible_version': _ansible_version()})
+
+    def _plugin_filename(self, plugin_type, plugin):
+        plugin_dir_name = loaders.ANSIBLE_DOC_PLUGIN_MAP.get(plugin_type, plugin_type)
+        rel_name = plugin[len(self.fq_collection_name) + 1:]
+        return f"plugins/{plugin_dir_name}/{rel_name.replace('.', '/')}.py"
+
+    def _plugin_cache_key(self, plugin_type, plugin):
+        sha256 = self.file_sha256s.get(self._plugin_filename(plugin_type, plugin))
+        if sha256 is None:
+            return None
+        return cache.fingerprint({'plugin': plugin,
+                                  'plugin_type': plugin_type,
+                                  'sha256': sha256,
+                                  'context': self.context_fingerprint})
+
+    def _run_ansible_doc(self, plugin_type, plugins):
+        if self.doc_cache is None:
+            return super()._run_ansible_doc(plugin_type, plugins)
+
+        data = {}
+        cache_keys = {}
+        uncached_plugins = []
+        for plugin in plugins:
+            cache_key = self._plugin_cache_key(plugin_type, plugin)
+            cached = self.doc_cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                data[plugin] = cached
+                continue
+            cache_keys[plugin] = cache_key
+            uncached_plugins.append(plugin)
+
+        self.log.debug('ansible-doc cache hits for %s of %s %s plugins',
+                       len(data), len(plugins), plugin_type)
+
+        if not uncached_plugins:
+            return data
+
+        new_data = super()._run_ansible_doc(plugin_type, uncached_plugins)
+        for plugin, plugin_data in new_data.items():
+            if cache_keys.get(plugin):
+                self.doc_cache.put(cache_keys[plugin], plugin_data)
+        data.update(new_data)
+
+        return data
+
 
 class CollectionAndManifestLoader(CollectionLoader):
-    def __init__(self, path, filename, cfg=None, logger=None):
+    def __init__(self, path, filename, cfg=None, logger=None,
+                 b_manifest=None, b_file_manifest=None, doc_cache=None):
         super().__init__(path, filename, cfg=cfg, logger=logger)
 
+        # optional cache.ContentCache for per plugin ansible-doc results
+        self.doc_cache = doc_cache
+
         # keep ref to the MANIFEST.json contents as bytes
-        self.b_manifest = None
+        # If the artifact reader already has them, they are not read from disk again.
+        self.b_manifest = b_manifest
 
         self.file_manifest_filename = None
-        self.b_file_manifest = None
+        self.b_file_manifest = b_file_manifest
         # self.galaxy_yml = None
 
+    def load(self):
+        # Same steps as CollectionLoader.load(), but with a CachingDocStringLoader
+        self._load_collection_manifest()
+        self._rename_extract_path()
+        self._check_filename_matches_manifest()
+        self._check_metadata_filepaths()
+
+        self.doc_strings = {}
+        if self.cfg.run_ansible_doc:
+            self.doc_strings = CachingDocStringLoader(
+                path=self.path,
+                fq_collection_name='{}.{}'.format(self.metadata.namespace, self.metadata.name),
+                logger=self.log,
+                cfg=self.cfg,
+                doc_cache=self.doc_cache,
+                file_sha256s=file_manifest_sha256s(self.b_file_manifest),
+            ).load()
+
+        self.content_objs = list(self._load_contents())
+
+        self.contents = self._build_contents_blob()
+        self.docs_blob = self._build_docs_blob()
+
+        return schema.ImportResult(
+            metadata=self.metadata,
+            docs_blob=self.docs_blob,
+            contents=self.contents,
+        )
+
     def _load_collection_manifest(self):
-        manifest_file = os.path.join(self.path, 'MANIFEST.json')
-        if not os.path.exists(manifest_file):
-            raise exc.ManifestNotFound(f'No manifest file ("{manifest_file}") found in collection from {self.filename}')
-
-        # read as bytes to ensure exact match for shasum/sigs
-        with open(manifest_file, 'rb') as f:
-            self.b_manifest = f.read()
-
-        with open(manifest_file, 'r') as f:
-            manifest = f.read()
-            try:
-                data = schema.CollectionArtifactManifest.parse(manifest)
-            except ValueError as e:
-                error_msg = f'Error loading artifact manifest "{manifest_file}" from {self.filename}: {str(e)}'
-                raise exc.ManifestValidationError(error_msg)
-            self.metadata = data.collection_info
-
-            # side effect, bit file_manifest_filename is used elsewhere
-            self.file_manifest_filename = data.file_manifest_file['name']
+        if self.b_manifest is None:
+            manifest_file = os.path.join(self.path, 'MANIFEST.json')
+            if not os.path.exists(manifest_file):
+                raise exc.ManifestNotFound(f'No manifest file ("{manifest_file}") found in collection from {self.filename}')
+
+            # read as bytes to ensure exact match for shasum/sigs
+            with open(manifest_file, 'rb') as f:
+                self.b_manifest = f.read()
+
+        data = parse_manifest(self.b_manifest, self.filename)
+        self.metadata = data.collection_info
+
+        # side effect, bit file_manifest_filename is used elsewhere
+        self.file_manifest_filename = data.file_manifest_file['name']
 
+        if self.b_file_manifest is None:
             file_manifest = os.path.join(self.path, self.file_manifest_filename)
             if not os.path.exists(file_manifest):
                 raise exc.ManifestNotFound(f'No file_manifest_file ({file_manifest} found in collection from {self.filename}')
@@ -1,4 +1,6 @@
+import hashlib
 import logging
+import os.path
 import pathlib
 import attr
 
@@ -6,6 +8,10 @@ from galaxy_importer import schema
 
 log = logging.getLogger(__name__)
 
+# 'full' runs the galaxy_importer CollectionLoader (ansible-doc, lint, etc per galaxy_importer_config)
+# 'metadata' builds the LoaderResult from MANIFEST.json, the file manifest and the README only
+IMPORT_MODES = ('full', 'metadata')
+
 
 def convert_path(path):
     return pathlib.Path(path).expanduser().resolve()
@@ -46,6 +52,33 @@ class ArtifactInfo(object):
     mtime = attr.ib()
 
 
+@attr.s()
+class ArtifactContents(object):
+    '''The parts of a collection artifact read while streaming it.'''
+    artifact_info = attr.ib(type=ArtifactInfo)
+    b_manifest = attr.ib(default=None, type=bytes)
+    file_manifest_filename = attr.ib(default=None)
+    b_file_manifest = attr.ib(default=None, type=bytes)
+    # top level member name -> bytes
+    members = attr.ib(factory=dict)
+
+
+@attr.s()
+class ImportJob(object):
+    '''One artifact to import, and every (warehouse_name, path) that wants the result.'''
+    collection_path = attr.ib(converter=convert_path)
+    warehouse_info = attr.ib()
+    destinations = attr.ib(factory=list)
+
+
+@attr.s()
+class ImportFailure(object):
+    '''An artifact that could not be imported, in place of its LoaderResult.'''
+    collection_path = attr.ib(converter=convert_path)
+    reason = attr.ib()
+    attempts = attr.ib(default=1)
+
+
 @attr.s()
 class LoaderResult(schema.ImportResult):
     artifact_info = attr.ib(type=ArtifactInfo, default=None)
@@ -54,6 +87,54 @@ class LoaderResult(schema.ImportResult):
     file_manifest_filename = attr.ib(default=None)
 
 
+@attr.s(frozen=True)
+class CollectionVersionData(object):
+    '''The data for one imported collection version.
+
+    The version node and the files built from it all share this one instance,
+    and it is the only copy in SNAPSHOT.json.'''
+    # attr.asdict() of the galaxy_importer CollectionInfo, DocsBlob and ArtifactInfo
+    metadata = attr.ib(factory=dict)
+    docs_blob = attr.ib(factory=dict)
+    artifact = attr.ib(factory=dict)
+    file_manifest_filename = attr.ib(default=None)
+    # The manifest bytes are not kept in snapshots and can be released after they
+    # are written, the sums are kept so they can be checked when read back.
+    manifest_sha256 = attr.ib(default=None)
+    file_manifest_sha256 = attr.ib(default=None)
+    b_manifest = attr.ib(default=None, type=bytes)
+    b_file_manifest = attr.ib(default=None, type=bytes)
+
+    @staticmethod
+    def _sha256(b_contents):
+        if b_contents is None:
+            return None
+        return hashlib.sha256(b_contents).hexdigest()
+
+    @classmethod
+    def from_loader_result(cls, loader_result):
+        return cls(metadata=attr.asdict(loader_result.metadata),
+                   docs_blob=attr.asdict(loader_result.docs_blob),
+                   artifact=attr.asdict(loader_result.artifact_info),
+                   file_manifest_filename=loader_result.file_manifest_filename,
+                   manifest_sha256=cls._sha256(loader_result.b_manifest),
+                   file_manifest_sha256=cls._sha256(loader_result.b_file_manifest),
+                   b_manifest=loader_result.b_manifest,
+                   b_file_manifest=loader_result.b_file_manifest)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(metadata=data.get('metadata', {}),
+                   docs_blob=data.get('docs_blob', {}),
+                   artifact=data.get('artifact', {}),
+                   file_manifest_filename=data.get('file_manifest_filename'),
+                   manifest_sha256=data.get('manifest_sha256'),
+                   file_manifest_sha256=data.get('file_manifest_sha256'))
+
+    def without_bytes(self):
+        return attr.evolve(self, b_manifest=None, b_file_manifest=None)
+
+
 @attr.s
 class ServerInfo():
     url = attr.ib(default="http://localhost/")
@@ -87,6 +168,10 @@ class WarehouseInfo():
     incremental = attr.ib(default=True,
                           converter=attr.converters.default_if_none(True))
 
+    import_mode = attr.ib(default='full',
+                          converter=attr.converters.default_if_none('full'),
+                          validator=attr.validators.in_(IMPORT_MODES))
+
     collections = attr.ib(factory=list,
                           validator=attr.validators.deep_iterable(
                               member_validator=attr.validators.instance_of(pathlib.Path),
@@ -103,10 +188,69 @@ class WarehouseInfo():
                        url_prefix=data.get('url_prefix'),
                        templates_dir=data.get('templates_dir'),
                        incremental=data.get('incremental'),
+                       import_mode=data.get('import_mode'),
                        collections=data.get('collections', []))
         return instance
 
 
+@attr.s(frozen=True)
+class ImporterInfo():
+    '''App wide settings for importing collection artifacts'''
+
+    # dir for the LoaderResult cache, or None to not cache imports
+    cache_dir = attr.ib(default=None)
+    # in bytes, None for the cache.ContentCache default
+    cache_max_size = attr.ib(default=None)
+
+    # dir for the per plugin ansible-doc cache, or None to not cache docs
+    doc_cache_dir = attr.ib(default=None)
+    doc_cache_max_size = attr.ib(default=None)
+
+    # import worker pool, None for os.cpu_count() workers
+    workers = attr.ib(default=None)
+    # multiprocessing start method ('fork', 'spawn', 'forkserver'), None for the platform default
+    start_method = attr.ib(default=None)
+    maxtasksperchild = attr.ib(default=None)
+    # artifacts sent to a worker at a time
+    chunksize = attr.ib(default=1,
+                        converter=attr.converters.default_if_none(1))
+
+    # per artifact wall clock limit in seconds, None for no limit
+    timeout = attr.ib(default=None)
+    # per worker address space limit in bytes, None for no limit
+    memory_limit = attr.ib(default=None)
+    # times to retry a failed or timed out import before skipping it
+    retries = attr.ib(default=0,
+                      converter=attr.converters.default_if_none(0))
+
+    @staticmethod
+    def _cache_dir(data, name):
+        if not data.get(name, True):
+            return None
+
+        cache_dir = data.get(f'{name}_dir')
+        if not cache_dir and data.get('snapshot_dir'):
+            cache_dir = os.path.join(data['snapshot_dir'], name)
+
+        if cache_dir:
+            cache_dir = os.path.normpath(os.path.expanduser(cache_dir))
+        return cache_dir
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(cache_dir=cls._cache_dir(data, 'import_cache'),
+                   cache_max_size=data.get('import_cache_max_size'),
+                   doc_cache_dir=cls._cache_dir(data, 'doc_cache'),
+                   doc_cache_max_size=data.get('doc_cache_max_size'),
+                   workers=data.get('import_workers'),
+                   start_method=data.get('import_start_method'),
+                   maxtasksperchild=data.get('import_maxtasksperchild'),
+                   chunksize=data.get('import_chunksize'),
+                   timeout=data.get('import_timeout'),
+                   memory_limit=data.get('import_memory_limit'),
+                   retries=data.get('import_retries'))
+
+
 @attr.s
 class ConfigInfo():
     warehouse_defaults = attr.ib(type=WarehouseInfo,
@@ -120,6 +264,9 @@ class ConfigInfo():
                          validator=attr.validators.instance_of(dict),
                          converter=attr.converters.default_if_none(factory=dict))
 
+    importer = attr.ib(factory=ImporterInfo,
+                       validator=attr.validators.instance_of(ImporterInfo))
+
     @classmethod
     def from_dict(cls, data):
         app_data = data.get('app', {})
@@ -153,7 +300,8 @@ class ConfigInfo():
         wh_defaults = WarehouseInfo.from_dict(wh_defaults_data, 'warehouse_defaults')
         instance = cls(app=app_data,
                        warehouse_defaults=wh_defaults,
-                       warehouses=warehouses)
+                       warehouses=warehouses,
+                       importer=ImporterInfo.from_dict(app_data))
         return instance
 
 
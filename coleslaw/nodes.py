@@ -1,14 +1,19 @@
+import bisect
+import collections
 import functools
+import hashlib
 import json
 import logging
+import operator
 import os.path
 import shutil
+import stat
+import tarfile
 
 import attr
 
 from anytree import (
     NodeMixin,
-    Resolver,
     # PreOrderIter,
     # LevelOrderIter,
     ChildResolverError,
@@ -22,6 +27,8 @@ import anytree.search
 
 import semantic_version
 
+from . import archive
+from . import checksums
 from . import jsonutils
 from . import models
 from . import utils
@@ -41,19 +48,7 @@ def only_path_node_filter(nodes):
 
 def highest_version_node(versions_node):
     # versions_node is the node that is the parent to the '0.0.1' nodes ({names[ace/name/versions)
-    # TODO: could maybe add a semantic_version.Version() to the collection version nodes
-    #       do a sort(nodes, key=node.semver,...) ish
-
-    # Find the version nodes up one and down one in ./versions/*/
-    version_nodes = [x for x in versions_node.children if isinstance(x, PathNode) and hasattr(x, 'version')]
-
-    # according to docs, SimpleSpec with trailing - will make the compares include pre-release
-    spec = semantic_version.SimpleSpec('>=0.0.0-')
-    version_map = dict([(semantic_version.Version(ver.version), ver) for ver in version_nodes])
-    best = spec.select(version_map.keys())
-    best_node = version_map[best]
-
-    return best_node
+    return versions_node.version_nodes()[-1]
 
 
 # from anytree.search
@@ -68,10 +63,166 @@ def _filter_by_hasattr(node, name):
     return hasattr(node, name)
 
 
+def cached_path(func):
+    '''A property that is computed once and kept in the _excluded_{name} slot
+
+    BaseNode._invalidate_paths() clears it when the node or an ancestor moves or is renamed.'''
+    cache_attr = f'_excluded_{func.__name__}'
+
+    @functools.wraps(func)
+    def getter(self):
+        try:
+            return getattr(self, cache_attr)
+        except AttributeError:
+            value = func(self)
+            setattr(self, cache_attr, value)
+            return value
+
+    return property(getter)
+
+
+PATH_CACHE_ATTRS = ('_excluded_pth', '_excluded_fs_pth', '_excluded_url_pth', '_excluded_warehouse_node')
+
+
+@attr.s(frozen=True)
+class LeafSpec(object):
+    '''A child node built from its parents data when it is needed, see BaseNode.leaf_specs'''
+    node_class = attr.ib()
+    # the child name, or a callable that returns it for the parent node
+    name = attr.ib()
+    # callable that returns the node_class kwargs for the parent node
+    kwargs = attr.ib(default=None)
+
+    def name_for(self, parent):
+        if callable(self.name):
+            return self.name(parent)
+        return self.name
+
+    def build(self, parent, name):
+        kwargs = self.kwargs(parent) if self.kwargs else {}
+        node = self.node_class(name, **kwargs)
+        # Point the node at its parent without attaching it, so it is not
+        # in the parents list of children, the indexes, or the snapshot.
+        node._NodeMixin__parent = parent
+        node._excluded_virtual = True
+        return node
+
+
+def is_warehouse_node(node):
+    return 'warehouse_name' in node.__dict__
+
+
+def relative_to(path, start):
+    '''os.path.relpath() for a normalized path below start, without the abspath() calls'''
+    prefix = start.rstrip(os.sep) + os.sep
+    if path.startswith(prefix):
+        return path[len(prefix):]
+    return os.path.relpath(path, start)
+
+
+def output_files(nodes):
+    '''The nodes in nodes that are files on disk, or have not been saved yet.
+
+    A clean node whose file went missing from the output since the last export
+    is marked dirty and saved again first.'''
+    files = []
+    for node in nodes:
+        try:
+            is_dir = stat.S_ISDIR(os.stat(node.fs_pth).st_mode)
+        except FileNotFoundError:
+            if node.is_dirty:
+                # not saved yet, ie the aggregates saved after this one
+                files.append(node)
+                continue
+            log.warning('%s is missing from the output, saving it again', node.fs_pth)
+            node.mark_dirty()
+            os.makedirs(os.path.dirname(node.fs_pth), exist_ok=True)
+            node.save()
+            node.mark_saved()
+            is_dir = os.path.isdir(node.fs_pth)
+        if not is_dir:
+            files.append(node)
+    return files
+
+
+def version_node_key(node):
+    return (getattr(node, 'namespace', None), getattr(node, 'collection', None), node.version)
+
+
+class WarehouseIndexes(object):
+    '''Secondary indexes for the nodes under a warehouse node, so lookups do not walk the tree.
+
+    Kept on the warehouse node and updated by the attach/detach hooks.'''
+
+    def __init__(self):
+        # node class name -> {node: None}, a dict as an insertion ordered set
+        self.by_type = collections.defaultdict(dict)
+        # 'namespace.name' -> the v3/collections/{namespace}/{name}/ node
+        self.by_collection_label = {}
+        # (namespace, name, version) -> the v3/collections/{namespace}/{name}/versions/{version}/ node
+        self.by_version = {}
+
+    def add(self, node):
+        self.by_type[node.__class__.__name__][node] = None
+        if not isinstance(node, PathNode):
+            return
+        if node.is_version_node():
+            self.by_version.setdefault(version_node_key(node), node)
+        elif 'collection_label' in node.__dict__:
+            self.by_collection_label.setdefault(node.collection_label, node)
+
+    def remove(self, node):
+        self.by_type[node.__class__.__name__].pop(node, None)
+        if not isinstance(node, PathNode):
+            return
+        if node.is_version_node():
+            key = version_node_key(node)
+            if self.by_version.get(key) is node:
+                del self.by_version[key]
+        elif 'collection_label' in node.__dict__:
+            if self.by_collection_label.get(node.collection_label) is node:
+                del self.by_collection_label[node.collection_label]
+
+
 class BaseNode(NodeMixin, object):
+    # NodeMixin does not use __slots__, so nodes always have a __dict__. That only holds
+    # the exported fields (name, _node_type and the kwargs), everything structural or
+    # runtime only is in a slot, which also keeps it out of the exporters.
+    __slots__ = ('_NodeMixin__parent',
+                 '_NodeMixin__children',
+                 '_excluded_children_by_name',
+                 '_excluded_exported',
+                 '_excluded_semver',
+                 '_excluded_versions_index',
+                 '_excluded_sort_key',
+                 '_excluded_warehouse_indexes',
+                 '_excluded_virtual',
+                 '_excluded_virtual_children',
+                 '_excluded_saved_sha256',
+                 '_excluded_virtual_saved_sha256s',
+                 '_excluded_dirty',
+                 '_excluded_dirty_below',
+                 '_excluded_dirty_virtual_keys',
+                 '_excluded_dirty_tracking',
+                 '_excluded_child_readers',
+                 '_excluded_previous_sha256s',
+                 ) + PATH_CACHE_ATTRS
+
     _exclude_attrs = ['_exclude_attrs']
     path_trailer = ""
 
+    # writers.export_order() saves siblings with a higher phase after the others
+    export_phase = 0
+
+    # How far below its parent the contents of this node read: 0 for just its
+    # own data, 1 for its siblings, 2 for their children, None for all of it.
+    # Attaching or changing a node marks the nodes that read it dirty.
+    dirty_depth = 0
+
+    # LeafSpecs for children that are derived from this nodes data. They are built
+    # when first needed and can be dropped again with release().
+    leaf_specs = ()
+
     def __init__(self, name, parent=None, children=None, **kwargs):
         self.__dict__.update(kwargs)
         self.name = name
@@ -80,17 +231,449 @@ class BaseNode(NodeMixin, object):
             self.children = children
         self._node_type = self.__class__.__name__
 
+    # NodeMixin.children creates an empty list the first time it is read, which
+    # for the leaf nodes that are most of the tree is just wasted memory.
+    # Virtual children (see leaf_specs) come after the attached ones.
     @property
+    def children(self):
+        try:
+            children = tuple(self._NodeMixin__children)
+        except AttributeError:
+            children = ()
+        if self.leaf_specs:
+            return children + self.virtual_children()
+        return children
+
+    children = children.setter(NodeMixin.children.fset).deleter(NodeMixin.children.fdel)
+
+    # 'name' is kept in __dict__ so the exporters still see it, but renaming
+    # a node has to update its parents index of children by name.
+    @property
+    def name(self):
+        return self.__dict__['name']
+
+    @name.setter
+    def name(self, value):
+        if 'name' not in self.__dict__:
+            # new node, so no parent or cached paths yet
+            self.__dict__['name'] = value
+            return
+        old_name = self.__dict__['name']
+        self.__dict__['name'] = value
+        parent = self.parent
+        if parent is not None and old_name != value:
+            parent._unindex_child(self, old_name)
+            parent._index_child(self)
+        if old_name != value:
+            self._invalidate_paths()
+            try:
+                del self._excluded_sort_key
+            except AttributeError:
+                pass
+
+    @property
+    def is_virtual(self):
+        return getattr(self, '_excluded_virtual', False)
+
+    def _real_children(self):
+        return getattr(self, '_NodeMixin__children', ())
+
+    def virtual_children(self):
+        '''The children built from leaf_specs, skipping any that an attached child already has the name of'''
+        try:
+            return self._excluded_virtual_children
+        except AttributeError:
+            real_names = self._children_by_name()
+            virtual_children = []
+            for spec in self.leaf_specs:
+                name = spec.name_for(self)
+                if name not in real_names:
+                    virtual_children.append(spec.build(self, name))
+            self._excluded_virtual_children = tuple(virtual_children)
+            return self._excluded_virtual_children
+
+    def release(self):
+        '''Drop whatever this subtree can build or load again when it is next needed.
+
+        ie, the virtual children and any payloads that have been written out.'''
+        for node in self._real_subtree():
+            if hasattr(node, '_excluded_virtual_children'):
+                del node._excluded_virtual_children
+            node.release_payload()
+
+    def release_payload(self):
+        pass
+
+    def _saved_sha256_owner(self):
+        '''The attached node that keeps the saved sha256 for self, and its key there.
+
+        Virtual nodes come and go with release(), so theirs are kept by the
+        nearest attached ancestor, keyed by the path down from it.'''
+        node = self
+        names = []
+        while node.is_virtual:
+            names.append(node.name)
+            node = node.parent
+        return node, '/'.join(reversed(names))
+
+    def record_saved_sha256(self, sha256):
+        '''Remember the sha256 of the file save() just wrote'''
+        owner, key = self._saved_sha256_owner()
+        if not key:
+            self._excluded_saved_sha256 = sha256
+            return
+        try:
+            owner._excluded_virtual_saved_sha256s[key] = sha256
+        except AttributeError:
+            owner._excluded_virtual_saved_sha256s = {key: sha256}
+
+    def saved_sha256(self):
+        '''The sha256 of the file as this node last saved it, or None if it has not been saved in this run'''
+        owner, key = self._saved_sha256_owner()
+        if not key:
+            return getattr(self, '_excluded_saved_sha256', None)
+        return getattr(owner, '_excluded_virtual_saved_sha256s', {}).get(key)
+
+    def known_sha256(self):
+        '''The sha256 of this nodes file if it is known without reading the file'''
+        sha256 = self.saved_sha256()
+        if sha256 is None and not self.is_dirty:
+            # unchanged since the last export, so it was not saved again
+            sha256 = self._previous_sha256()
+        return sha256
+
+    def _previous_sha256(self):
+        # the path relative to the warehouse, from the names on the way up to it
+        names = []
+        node = self
+        while node is not None and not is_warehouse_node(node):
+            names.append(str(node.name))
+            node = node.parent
+        if node is None:
+            return None
+        return node._previous_sha256s().get('/'.join(reversed(names)))
+
+    def _previous_sha256s(self):
+        '''{path: sha256} from the SHA256SUMS of the last export of this warehouse node.
+
+        Only read if mark_clean() said that export is still current.'''
+        sha256s = getattr(self, '_excluded_previous_sha256s', {})
+        if sha256s is None:
+            sums_node = self.get_child('SHA256SUMS')
+            sha256s = {}
+            if isinstance(sums_node, IndexSha256sumNode) and sums_node._recursive:
+                sha256s = sums_node.read_sha256s()
+            self._excluded_previous_sha256s = sha256s
+        return sha256s
+
+    def _real_owner(self):
+        '''self, or for a virtual node the attached node it was built from'''
+        node = self
+        while node.is_virtual:
+            node = node.parent
+        return node
+
+    @property
+    def is_dirty(self):
+        '''True if the next export has to save this node. New nodes are dirty.'''
+        if not self.is_virtual:
+            return getattr(self, '_excluded_dirty', True)
+        # with the other virtual nodes of its owner, or on its own
+        owner, key = self._saved_sha256_owner()
+        return getattr(owner, '_excluded_dirty', True) or key in getattr(owner, '_excluded_dirty_virtual_keys', ())
+
+    @property
+    def needs_export(self):
+        '''True if this node or anything under it has to be saved'''
+        if self.is_virtual:
+            if self.is_dirty:
+                return True
+            owner, key = self._saved_sha256_owner()
+            prefix = f'{key}/'
+            return any(dirty_key.startswith(prefix)
+                       for dirty_key in getattr(owner, '_excluded_dirty_virtual_keys', ()))
+        return getattr(self, '_excluded_dirty', True) or getattr(self, '_excluded_dirty_below', True)
+
+    def mark_clean(self, previous_sha256s=None):
+        '''Flag this subtree as already exported, ie, its files on disk are current.
+
+        From then on, changes under its warehouse mark the nodes that read them dirty.
+        previous_sha256s is the {path: sha256} of its last SHA256SUMS, if already read.'''
+        for node in self._real_subtree():
+            node._excluded_dirty = False
+            node._excluded_dirty_below = False
+            node._excluded_dirty_virtual_keys = ()
+        warehouse_node = self.warehouse_node
+        if warehouse_node is not None:
+            warehouse_node._excluded_dirty_tracking = True
+            # the sums of the files that are not saved again come from its last SHA256SUMS
+            warehouse_node._excluded_previous_sha256s = previous_sha256s
+
+    def mark_saved(self):
+        '''Flag this node as exported, once it and its virtual children have been saved'''
+        if self.is_virtual:
+            return
+        self._excluded_dirty = False
+        self._excluded_dirty_below = False
+        self._excluded_dirty_virtual_keys = ()
+        warehouse_node = self.warehouse_node
+        if warehouse_node is not None:
+            warehouse_node._excluded_dirty_tracking = True
+
+    def mark_dirty(self):
+        '''Flag this node to be saved by the next export, along with every node that reads it'''
+        if self.is_virtual:
+            self._mark_virtual_dirty()
+            return
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            # a dirty node's readers are already dirty
+            if getattr(node, '_excluded_dirty', True):
+                continue
+            node._excluded_dirty = True
+            if node.parent is not None:
+                node.parent._flag_dirty_below()
+            nodes.extend(node._readers(node.parent))
+
+    def _mark_virtual_dirty(self):
+        # Flagged on its owner, so the other virtual nodes built from the
+        # same data are not saved again with it.
+        owner, key = self._saved_sha256_owner()
+        dirty_keys = getattr(owner, '_excluded_dirty_virtual_keys', ())
+        if getattr(owner, '_excluded_dirty', True) or key in dirty_keys:
+            return
+        owner._excluded_dirty_virtual_keys = dirty_keys + (key,)
+        owner._flag_dirty_below()
+        # read by the nodes that read that far below the owner
+        for reader in list(owner._readers(owner.parent, depth=2 + key.count('/'))):
+            reader.mark_dirty()
+
+    def changed(self):
+        '''Mark what reads this node dirty after its data is changed in place'''
+        self.mark_dirty()
+
+    def mark_templates_changed(self, template_names):
+        '''Mark the nodes in this subtree that are rendered from any of template_names dirty'''
+        for node in anytree.PreOrderIter(self):
+            if getattr(node, 'template_name', None) in template_names:
+                node.mark_dirty()
+
+    def _flag_dirty_below(self):
+        node = self
+        while node is not None and not getattr(node, '_excluded_dirty_below', True):
+            node._excluded_dirty_below = True
+            node = node.parent
+
+    def _tracks_dirty(self):
+        '''False until something under this nodes warehouse is clean, since until then there is nothing to mark dirty'''
+        warehouse_node = self.warehouse_node
+        return warehouse_node is None or getattr(warehouse_node, '_excluded_dirty_tracking', False)
+
+    def _child_readers(self):
+        '''The attached children with a dirty_depth'''
+        try:
+            return self._excluded_child_readers
+        except AttributeError:
+            self._excluded_child_readers = tuple(child for child in self._real_children()
+                                                 if child.dirty_depth != 0)
+            return self._excluded_child_readers
+
+    def _readers(self, parent, depth=1):
+        '''The nodes whose contents read this node, when it is depth levels below parent'''
+        ancestor = parent
+        while ancestor is not None:
+            for reader in ancestor._child_readers():
+                dirty_depth = reader.dirty_depth
+                if reader is not self and (dirty_depth is None or dirty_depth >= depth):
+                    yield reader
+            ancestor = ancestor.parent
+            depth += 1
+
+    def _mark_readers_dirty(self, parent):
+        if self.dirty_depth != 0:
+            try:
+                del parent._excluded_child_readers
+            except AttributeError:
+                pass
+        if not parent._tracks_dirty():
+            return
+        for reader in list(self._readers(parent)):
+            reader.mark_dirty()
+
+    def _real_subtree(self, stop=None):
+        '''Pre-order self and the attached descendants, without building any virtual children'''
+        # Most nodes being attached are new leaves, so skip the walk for them
+        if not self._real_children():
+            return (self,)
+        return self._iter_real_subtree(stop)
+
+    def _iter_real_subtree(self, stop):
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            yield node
+            children = node._real_children()
+            if children:
+                nodes.extend(child for child in reversed(children) if not (stop and stop(child)))
+
+    def _children_by_name(self):
+        try:
+            return self._excluded_children_by_name
+        except AttributeError:
+            children_by_name = {}
+            for child in self._real_children():
+                children_by_name.setdefault(child.name, child)
+            self._excluded_children_by_name = children_by_name
+            return children_by_name
+
+    def _index_child(self, child):
+        # Like Resolver, the first child with a name wins
+        self._children_by_name().setdefault(child.name, child)
+
+    def _unindex_child(self, child, name):
+        children_by_name = getattr(self, '_excluded_children_by_name', None)
+        if children_by_name is None or children_by_name.get(name) is not child:
+            return
+        del children_by_name[name]
+        for other_child in self._real_children():
+            if other_child is not child and other_child.name == name:
+                children_by_name[name] = other_child
+                break
+
+    def is_version_node(self):
+        '''True for the 'versions/0.0.1' style dirs'''
+        return isinstance(self, PathNode) and 'version' in self.__dict__
+
+    @property
+    def semver(self):
+        '''self.version as a semantic_version.Version, parsed once'''
+        try:
+            return self._excluded_semver
+        except AttributeError:
+            self._excluded_semver = semantic_version.Version(self.version)
+            return self._excluded_semver
+
+    def _versions_index(self):
+        # ([semver, ...], [version_node, ...]), both in ascending semver order
+        try:
+            return self._excluded_versions_index
+        except AttributeError:
+            self._excluded_versions_index = ([], [])
+            return self._excluded_versions_index
+
+    def _index_version(self, child):
+        semvers, version_nodes = self._versions_index()
+        pos = bisect.bisect_right(semvers, child.semver)
+        semvers.insert(pos, child.semver)
+        version_nodes.insert(pos, child)
+
+    def _unindex_version(self, child):
+        semvers, version_nodes = self._versions_index()
+        for pos, version_node in enumerate(version_nodes):
+            if version_node is child:
+                del semvers[pos]
+                del version_nodes[pos]
+                return
+
+    def version_nodes(self):
+        '''The version node children, lowest version first'''
+        return list(self._versions_index()[1])
+
+    def _invalidate_paths(self):
+        for node in self._real_subtree():
+            for cache_attr in PATH_CACHE_ATTRS:
+                if hasattr(node, cache_attr):
+                    delattr(node, cache_attr)
+            # virtual children have their own cached paths, so just build them again
+            if hasattr(node, '_excluded_virtual_children'):
+                del node._excluded_virtual_children
+
+    @cached_path
+    def warehouse_node(self):
+        '''The nearest warehouse node (one with a 'warehouse_name') at or above this node, or None'''
+        if is_warehouse_node(self):
+            return self
+        if self.parent is None:
+            return None
+        return self.parent.warehouse_node
+
+    def _warehouse_indexes(self):
+        try:
+            return self._excluded_warehouse_indexes
+        except AttributeError:
+            self._excluded_warehouse_indexes = WarehouseIndexes()
+            self._excluded_warehouse_indexes.add(self)
+            return self._excluded_warehouse_indexes
+
+    def _update_warehouse_indexes(self, parent, update):
+        # A warehouse node keeps its own indexes, so only the nodes
+        # down to the next warehouse node need to be (un)indexed.
+        if is_warehouse_node(self):
+            return
+        warehouse_node = parent.warehouse_node
+        if warehouse_node is None:
+            return
+        indexes = warehouse_node._warehouse_indexes()
+        for node in self._real_subtree(stop=is_warehouse_node):
+            update(indexes, node)
+
+    def _post_attach(self, parent):
+        parent._index_child(self)
+        if self.is_version_node():
+            parent._index_version(self)
+        self._update_warehouse_indexes(parent, WarehouseIndexes.add)
+        self._invalidate_paths()
+        if not getattr(self, '_excluded_dirty', True):
+            # a clean subtree moved here, so all of its paths changed
+            for node in self._real_subtree():
+                node._excluded_dirty = True
+                node._excluded_dirty_below = True
+        parent._flag_dirty_below()
+        self._mark_readers_dirty(parent)
+
+    def _post_detach(self, parent):
+        parent._unindex_child(self, self.name)
+        if self.is_version_node():
+            parent._unindex_version(self)
+        self._update_warehouse_indexes(parent, WarehouseIndexes.remove)
+        self._invalidate_paths()
+        self._mark_readers_dirty(parent)
+
+    def get_child(self, name, default=None):
+        '''Return the child named name, or default'''
+        child = self._children_by_name().get(name)
+        if child is not None:
+            return child
+        if self.leaf_specs:
+            for child in self.virtual_children():
+                if child.name == name:
+                    return child
+        return default
+
+    def get_path(self, path):
+        '''Same as Resolver('name').get(self, path) for relative paths like 'v3/collections', but without scanning children'''
+        node = self
+        for name in path.split(self.separator):
+            if not name:
+                continue
+            child = node.get_child(name)
+            if child is None:
+                raise ChildResolverError(node, name, 'name')
+            node = child
+        return node
+
+    @cached_path
     def pth(self):
         return self.separator.join([str(node.name) for node in self.path])
 
-    @property
+    @cached_path
     def fs_pth(self):
         _fs_root = getattr(self.root, "fs_prefix", "")
         path_parts = [str(node.name or _fs_root) for node in self.path]
         return os.path.normpath(self.separator.join(path_parts))
 
-    @property
+    @cached_path
     def url_pth(self):
         _url_prefix = getattr(self.root, "url_prefix", "")
         path_parts = [str(node.name or _url_prefix) for node in self.path]
@@ -103,24 +686,27 @@ class BaseNode(NodeMixin, object):
     def __lt__(self, other):
         return compare_nodes(self, other)
 
+    @property
+    def sort_key(self):
+        '''Tuple that sorts the same as compare_nodes(), for sorted(nodes, key=node_sort_key)'''
+        try:
+            return self._excluded_sort_key
+        except AttributeError:
+            self._excluded_sort_key = node_sort_key(self)
+            return self._excluded_sort_key
+
     # Method to use to insure we don't create siblings with the same name.
     def get_or_add_child(self, child_node):
         # log.debug('add_child self: %s, child_node: %s', self.name, child_node.name)
-        name_resolver = Resolver('name')
-        try:
-            existing_child = name_resolver.get(self, child_node.name)
+        existing_child = self.get_child(child_node.name)
+        if existing_child is not None:
             return existing_child
-        # singling with that name exists already
-        except ChildResolverError:
-            # log.debug('ResolverError for %s, already exist as sibling: %s', child_node.name, exc)
-            # don't need to do anything, already have a PathNode by that name
-            # log.exception(exc)
-            child_node.parent = self
-            return child_node
+
+        child_node.parent = self
+        return child_node
 
     def __repr__(self):
-        return "%s(%s)" % (self.__class__.__name__,
-                           self.separator.join([str(node.name) for node in self.path]))
+        return "%s(%s)" % (self.__class__.__name__, self.pth)
 
     def _yield_attr_values(self):
         for k, v in self.__dict__.items():
@@ -153,6 +739,36 @@ class BaseNode(NodeMixin, object):
                                       stop=stop, maxlevel=maxlevel,
                                       mincount=mincount, maxcount=maxcount)
 
+    def find_by_type(self, node_type):
+        '''Same nodes as findall(filter_by_attr('_node_type', node_type)), from the warehouse indexes'''
+        warehouse_node = self.warehouse_node
+        if warehouse_node is None:
+            return self.findall(filter_=self.filter_by_attr('_node_type', node_type))
+
+        found = warehouse_node._warehouse_indexes().by_type.get(node_type, {})
+        if warehouse_node is self:
+            return tuple(found)
+        return tuple(node for node in found if self in node.path)
+
+    def find_collection(self, collection_label):
+        '''The {namespace}/{name}/ node for 'namespace.name' in this nodes warehouse, or None'''
+        warehouse_node = self.warehouse_node
+        if warehouse_node is None:
+            return None
+        return warehouse_node._warehouse_indexes().by_collection_label.get(collection_label)
+
+    def find_version(self, namespace, name, version):
+        '''The versions/{version}/ node of namespace.name in this nodes warehouse, or None'''
+        warehouse_node = self.warehouse_node
+        if warehouse_node is None:
+            return None
+        return warehouse_node._warehouse_indexes().by_version.get((namespace, name, version))
+
+    def find_warehouses(self):
+        '''The warehouse nodes at or below this node, without searching inside the warehouses'''
+        return tuple(anytree.PreOrderIter(self, filter_=is_warehouse_node,
+                                          stop=lambda node: node is not self and is_warehouse_node(node.parent)))
+
     @staticmethod
     def filter_by_attr(name, value):
         # name = '_node_type'
@@ -178,7 +794,13 @@ class PathNode(BaseNode):
 
     def _makedir(self):
         # log.debug('MAKEDIRS %s', self.fs_pth)
-        os.makedirs(self.fs_pth, exist_ok=True)
+        # The parent is normally saved first, so one mkdir is enough
+        try:
+            os.mkdir(self.fs_pth)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            os.makedirs(self.fs_pth, exist_ok=True)
 
     def save(self):
         # log.debug('SAVE %s', self)
@@ -207,8 +829,10 @@ class IndexNode(BaseNode):
 
     def save(self, data=None):
         log.debug('SAVE %20s %s', self._node_type, self.fs_pth)
-        with open(self.fs_pth, 'w') as index_fo:
-            index_fo.write(self.body(data=data))
+        b_body = self.body(data=data).encode('utf-8')
+        if not utils.write_if_changed(self.fs_pth, b_body):
+            log.debug('%s is already up to date', self.fs_pth)
+        self.record_saved_sha256(hashlib.sha256(b_body).hexdigest())
 
     def reserve(self):
         '''Reserve the file path by creating it (makedir, touch) if it doesn't exist.'''
@@ -225,6 +849,9 @@ class IndexJsonNode(IndexNode):
 
 
 class CollectionIndexJsonNode(IndexJsonNode):
+    # the highest version in ./versions/*/
+    dirty_depth = 2
+
     def body(self, data=None):
         data = self.serialize()
         return json.dumps(data, indent=4)
@@ -239,12 +866,8 @@ class CollectionIndexJsonNode(IndexJsonNode):
                 }
 
     def highest_version(self):
-        # TODO: could maybe add a semantic_version.Version() to the collection version nodes
-        #       do a sort(nodes, key=node.semver,...) ish
-
         # Find the version nodes up one and down one in ./versions/*/
-        name_resolver = Resolver('name')
-        versions_node = name_resolver.get(self.parent, 'versions')
+        versions_node = self.parent.get_path('versions')
 
         best_node = highest_version_node(versions_node)
 
@@ -254,6 +877,8 @@ class CollectionIndexJsonNode(IndexJsonNode):
 
 class ListIndexJsonNode(IndexJsonNode):
     '''Node class for an index list view'''
+    dirty_depth = 1
+
     def __init__(self, name, parent=None, children=None,
                  **kwargs):
         self._item_type = kwargs.pop('_item_type', 'PathNode')
@@ -261,7 +886,6 @@ class ListIndexJsonNode(IndexJsonNode):
 
     def serialize_item(self, node, *args, **kwargs):
         '''Build the datastructure based on the passed in node and return an instance'''
-        res = dict_exporter.export(node)
         res = {'name': node.name, 'href': node.url_pth}
         # log.debug('serialize onelevel: %s', res)
 
@@ -286,7 +910,8 @@ class ListIndexJsonNode(IndexJsonNode):
         return json.dumps(data, indent=4)
 
     def index_of(self):
-        return sorted([x for x in self.siblings if x is not self and isinstance(x, NODE_TYPE_MAP[self._item_type])])
+        return sorted([x for x in self.siblings if x is not self and isinstance(x, NODE_TYPE_MAP[self._item_type])],
+                      key=by_sort_key)
 
 
 class VersionsIndexJsonNode(ListIndexJsonNode):
@@ -303,46 +928,114 @@ class VersionsIndexJsonNode(ListIndexJsonNode):
         return attr.asdict(collection_version_list_item)
 
     def index_of(self):
-        # Get all of the 'versions/0.0.1' style subdirs
-        return sorted([x for x in super().index_of() if isinstance(x, PathNode) and hasattr(x, 'version')])
+        # Get all of the 'versions/0.0.1' style subdirs, newest first
+        return self.parent.version_nodes()[::-1]
 
 
 class IndexBytesNode(IndexNode):
     '''Node class for file content that needs byte for byte node files
 
-    Ie, something that may be signed/chksumed like MANIFEST.json'''
-    def __init__(self, name, parent=None, children=None, b_filecontents=None, **kwargs):
+    Ie, something that may be signed/chksumed like MANIFEST.json
+
+    If b_filecontents has been released, the parent can provide them again with
+    a reload_leaf_bytes(name, sha256) method.'''
+    def __init__(self, name, parent=None, children=None, b_filecontents=None, sha256=None, **kwargs):
         super().__init__(name, parent=parent, children=children, **kwargs)
         self.b_filecontents = b_filecontents
+        self.sha256 = sha256
+
+    def filecontents(self):
+        if self.b_filecontents is not None:
+            return self.b_filecontents
+        reload_leaf_bytes = getattr(self.parent, 'reload_leaf_bytes', None)
+        if reload_leaf_bytes is None:
+            return b''
+        return reload_leaf_bytes(self.name, self.sha256) or b''
+
+    def is_current(self):
+        '''True if the file on disk already has the contents with sha256'''
+        if self.sha256 is None or not os.path.isfile(self.fs_pth):
+            return False
+        return utils.sha256sum_from_path(self.fs_pth) == self.sha256
 
     def save(self, data=None):
         log.debug('SAVE %20s %s', self._node_type, self.fs_pth)
-        b_filecontents = self.b_filecontents or b''
-        with open(self.fs_pth, 'wb') as index_fo:
-            index_fo.write(b_filecontents)
+        # Rather than reloading released contents just to write the same bytes again
+        if self.b_filecontents is None and self.is_current():
+            log.debug('%s is already up to date', self.fs_pth)
+            self.record_saved_sha256(self.sha256)
+            return
+
+        b_filecontents = self.filecontents()
+        if not utils.write_if_changed(self.fs_pth, b_filecontents):
+            log.debug('%s is already up to date', self.fs_pth)
+        self.record_saved_sha256(hashlib.sha256(b_filecontents).hexdigest())
+
+    def reserve(self):
+        '''Create the file if it doesn't exist, but unlike IndexNode, keep existing contents for is_current()'''
+        log.debug('RESERVING %15s %s', self._node_type, self.fs_pth)
+        with open(self.fs_pth, 'ab'):
+            pass
 
 
 class IndexArtifactNode(IndexNode):
     '''Node class for artifact archive leaf node files.
 
-    This copies the artifact file from it's original location into the warehouse tree.'''
+    This copies the artifact file from it's original location into the warehouse tree.
+
+    The sha256 from the import is reused for the copy, as long as the original
+    still has the size and mtime it was imported with. A copy that already
+    matches it is not copied again.'''
 
     def save(self, data=None):
         # log.debug('SAVE %s', self)
         log.debug('SAVE %20s %s', self._node_type, self.fs_pth)
+        imported_sha256_is_current = self.imported_sha256_is_current()
+        if imported_sha256_is_current and self.is_current():
+            log.debug('%s is already up to date', self.fs_pth)
+            self.record_saved_sha256(self.sha256)
+            return
+
         res = shutil.copy(self.collection_filename, self.fs_pth)
 
         log.debug('copy of %s -> %s returned %s',
                   self.collection_filename,
                   self.fs_pth, res)
 
+        if imported_sha256_is_current:
+            self.record_saved_sha256(self.sha256)
+
+    def is_current(self):
+        '''True if the copy already has the size and sha256 of the imported artifact'''
+        try:
+            stat_result = os.stat(self.fs_pth)
+        except FileNotFoundError:
+            return False
+        return stat_result.st_size == self.file_size and \
+            utils.sha256sum_from_path(self.fs_pth) == self.sha256
+
+    def known_sha256(self):
+        sha256 = super().known_sha256()
+        # save() copies the file the import already hashed
+        if sha256 is None and self.imported_sha256_is_current():
+            return self.sha256
+        return sha256
+
+    def imported_sha256_is_current(self):
+        sha256 = getattr(self, 'sha256', None)
+        if sha256 is None:
+            return False
+        artifact_info = archive.artifact_info_from_stat(self.collection_filename, sha256,
+                                                        os.stat(self.collection_filename))
+        return artifact_info.size == self.file_size and artifact_info.mtime == self.mtime
+
 
 class FsSymlinkNode(PathNode):
     '''Create a symlink from self.fs_pth to _target_node.fs_pth'''
     _exclude_attrs = PathNode._exclude_attrs + ['_target_is_directory']
 
     def save(self, data=None):
-        pass
+        self.reserve(data=data)
 
     def reserve(self, data=None):
         log.debug('Target node: %s', self._target_node)
@@ -359,7 +1052,13 @@ class FsSymlinkNode(PathNode):
         try:
             os.symlink(relpath, self.fs_pth, dir_fd=relative_to_dir_fd)
         except FileExistsError:
-            pass
+            # left by an earlier export, point it at the current target
+            if os.path.islink(self.fs_pth) and os.readlink(self.fs_pth) != relpath:
+                tmp_pth = f'{self.fs_pth}.tmp'
+                if os.path.lexists(tmp_pth):
+                    os.unlink(tmp_pth)
+                os.symlink(relpath, tmp_pth, dir_fd=relative_to_dir_fd)
+                os.replace(tmp_pth, self.fs_pth)
         finally:
             os.close(relative_to_dir_fd)
 
@@ -368,6 +1067,7 @@ class FsSymlinkNode(PathNode):
 
 class HighestVersionFsSymlinkNode(FsSymlinkNode):
     _exclude_attrs = FsSymlinkNode._exclude_attrs + ['_versions_subdir_node']
+    dirty_depth = 1
 
     @property
     def label(self):
@@ -387,6 +1087,7 @@ class HighestVersionFsSymlinkNode(FsSymlinkNode):
 
 class IndexJinjaNode(IndexNode):
     '''Node class for leaf nodes created from jinja templates'''
+    dirty_depth = 1
 
     def __init__(self, name, parent=None, children=None, **kwargs):
         self.template_name = kwargs.pop('template_name', 'default.html.j2')
@@ -405,7 +1106,7 @@ class IndexJinjaNode(IndexNode):
                                      })
 
     def index_of(self):
-        return sorted([x for x in self.siblings if x is not self])
+        return sorted([x for x in self.siblings if x is not self], key=by_sort_key)
 
 
 class IndexHtmlNode(IndexJinjaNode):
@@ -416,26 +1117,55 @@ class IndexHtmlNode(IndexJinjaNode):
 class IndexSha256sumNode(IndexNode):
     '''Node class for writing SHA256SUMS files'''
 
+    # after the files it sums, including any FILES.txt
+    export_phase = 2
+
     def __init__(self, name, parent=None, children=None,
                  _recursive=False, **kwargs):
         super().__init__(name, parent=parent, children=children, **kwargs)
         self._recursive = _recursive
 
+    @property
+    def dirty_depth(self):
+        return None if getattr(self, '_recursive', False) else 1
+
+    def read_sha256s(self):
+        '''{path: sha256} from the file as it is on disk'''
+        sha256s = {}
+        try:
+            with open(self.fs_pth, 'r') as sums_fo:
+                for line in sums_fo:
+                    sha256, _sep, rel_path = line.rstrip('\n').partition('  ')
+                    sha256s[rel_path] = sha256
+        except FileNotFoundError:
+            pass
+        return sha256s
+
+    def checksum_engine(self):
+        try:
+            return self.get_field('_excluded_checksum_engine')
+        except AttributeError:
+            return checksums.default_engine
+
     def body(self, data=None):
-        lines = []
-        for sibling in self.index_of():
-            if os.path.isdir(sibling.fs_pth):
-                continue
+        files = output_files(self.index_of())
 
-            # At some point, could attempt to make this multiprocessing'ed if it is cpu bound
-            sha256sum = utils.sha256sum_from_path(sibling.fs_pth)
+        # Only the files that were not saved in this run are read, all at once
+        sha256sums = dict((sibling.fs_pth, sibling.known_sha256()) for sibling in files)
+        unknown_paths = [path for path, sha256sum in sha256sums.items() if sha256sum is None]
+        if unknown_paths:
+            sha256sums.update(self.checksum_engine().sha256sums(unknown_paths))
+
+        parent_fs_pth = self.parent.fs_pth
+        lines = []
+        for sibling in files:
             rel_path = os.path.basename(sibling.fs_pth)
 
             # show relative path of descendants for recursive
             if self._recursive:
-                rel_path = os.path.relpath(sibling.fs_pth, self.parent.fs_pth)
+                rel_path = relative_to(sibling.fs_pth, parent_fs_pth)
 
-            line = f'{sha256sum}  {rel_path}'
+            line = f'{sha256sums[sibling.fs_pth]}  {rel_path}'
             lines.append(line)
 
         res = '\n'.join(lines)
@@ -445,9 +1175,9 @@ class IndexSha256sumNode(IndexNode):
         # Note: In constrast to IndexFileListNode, the shasum node should _NOT_ include itself in it's output,
         #       but it _should_ include other SHA256sums files.
         if self._recursive:
-            return [x for x in self.parent.descendants if x is not self]
+            return [x for x in sorted_descendants(self.parent) if x is not self]
         else:
-            return [x for x in self.siblings if not isinstance(x, IndexSha256sumNode) and x is not self]
+            return [x for x in sorted_siblings(self) if not isinstance(x, IndexSha256sumNode) and x is not self]
 
 
 class IndexFileListNode(IndexNode):
@@ -455,21 +1185,27 @@ class IndexFileListNode(IndexNode):
 
     Amongst other uses, for using with `git add --pathspec-from-file=file_list.txt`.'''
 
+    # after the dirs in it exist, so they can be left out
+    export_phase = 1
+
     def __init__(self, name, parent=None, children=None,
                  _recursive=False, **kwargs):
         super().__init__(name, parent=parent, children=children, **kwargs)
         self._recursive = _recursive
 
+    @property
+    def dirty_depth(self):
+        return None if getattr(self, '_recursive', False) else 1
+
     def body(self, data=None):
+        parent_fs_pth = self.parent.fs_pth
         lines = []
-        for sibling in self.index_of():
+        for sibling in output_files(self.index_of()):
             # log.debug('sibling.fs_pth: %s', sibling.fs_pth)
-            if os.path.isdir(sibling.fs_pth):
-                continue
             rel_path = os.path.basename(sibling.fs_pth)
             # show relative path of descendants for recursive
             if self._recursive:
-                rel_path = os.path.relpath(sibling.fs_pth, self.parent.fs_pth)
+                rel_path = relative_to(sibling.fs_pth, parent_fs_pth)
 
             line = f'{rel_path}'
 
@@ -481,9 +1217,146 @@ class IndexFileListNode(IndexNode):
     def index_of(self):
         # Note: In constrast to IndexSha256sumNode, the file list node _should_ include itself in it's output
         if self._recursive:
-            return [x for x in self.parent.descendants if not isinstance(x, IndexArtifactNode)]
+            return [x for x in sorted_descendants(self.parent) if not isinstance(x, IndexArtifactNode)]
         else:
-            return [x for x in self.siblings if not isinstance(x, IndexArtifactNode)]
+            return [x for x in sorted_siblings(self) if not isinstance(x, IndexArtifactNode)]
+
+
+def _version_index_json_kwargs(node):
+    return {'download_url': node.download_url,
+            'namespace': {'name': node.namespace},
+            'collection': {'name': node.collection},
+            'version': node.version,
+            'metadata': node.metadata,
+            'artifact': node.artifact,
+            }
+
+
+class DocsBlobNode(PathNode):
+    '''Node class for the versions/{version}/docs_blob/ dir, built from the CollectionVersionNode above it'''
+    leaf_specs = (
+        LeafSpec(IndexJsonNode, 'index.json',
+                 lambda node: node.parent.collection_data.docs_blob),
+        LeafSpec(IndexHtmlNode, 'index.html',
+                 lambda node: {'template_name': 'collection_version_docs_blob.html.j2',
+                               'docs_blob': node.parent.collection_data.docs_blob}),
+    )
+
+
+class CollectionVersionNode(PathNode):
+    '''Node class for a v3/collections/{namespace}/{name}/versions/{version}/ dir.
+
+    The version data is only kept in collection_data (a models.CollectionVersionData),
+    the files in the dir are virtual children built from it.'''
+    leaf_specs = (
+        LeafSpec(IndexJsonNode, 'index.json', _version_index_json_kwargs),
+        LeafSpec(IndexHtmlNode, 'README.html',
+                 lambda node: {'template_name': 'README.html.j2',
+                               'body_html': node.collection_data.docs_blob['collection_readme']['html']}),
+        LeafSpec(IndexHtmlNode, 'index.html',
+                 lambda node: {'template_name': 'collection_version.html.j2'}),
+        LeafSpec(DocsBlobNode, 'docs_blob'),
+        LeafSpec(IndexBytesNode, 'MANIFEST.json',
+                 lambda node: {'b_filecontents': node.collection_data.b_manifest,
+                               'sha256': node.collection_data.manifest_sha256}),
+        # FILES.json, or whatever file_manifest_filename points to
+        LeafSpec(IndexBytesNode,
+                 lambda node: node.collection_data.file_manifest_filename,
+                 lambda node: {'b_filecontents': node.collection_data.b_file_manifest,
+                               'sha256': node.collection_data.file_manifest_sha256}),
+    )
+
+    def __init__(self, name, parent=None, children=None, collection_data=None, **kwargs):
+        # a dict when loaded from a snapshot
+        if isinstance(collection_data, dict):
+            collection_data = models.CollectionVersionData.from_dict(collection_data)
+        self.collection_data = collection_data
+        super().__init__(name, parent=parent, children=children, **kwargs)
+
+    @property
+    def metadata(self):
+        return self.collection_data.metadata
+
+    @property
+    def artifact(self):
+        return self.collection_data.artifact
+
+    # the templates use artifact_info.size etc
+    artifact_info = artifact
+
+    def release_payload(self):
+        '''Drop the manifest bytes, reload_leaf_bytes() reads them from the artifact if they are needed again'''
+        self.collection_data = self.collection_data.without_bytes()
+
+    def reload_leaf_bytes(self, name, sha256=None):
+        '''Read the MANIFEST.json or file manifest bytes back from the artifact'''
+        artifact_path = self.artifact.get('full_path')
+        try:
+            b_contents = archive.read_members(artifact_path, [name]).get(name)
+        except (OSError, TypeError, tarfile.TarError) as exc:
+            log.warning('Unable to read %s from %s: %s', name, artifact_path, exc)
+            return None
+
+        if b_contents is not None and sha256 is not None and hashlib.sha256(b_contents).hexdigest() != sha256:
+            log.warning('%s in %s has changed since it was imported', name, artifact_path)
+        return b_contents
+
+
+@functools.total_ordering
+class _Descending(object):
+    '''Wraps a value so it sorts in reverse order inside a sort key tuple'''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def node_sort_key(node):
+    '''The compare_nodes() rules as a tuple: (kind, default/, version, index file, name)
+
+    compare_nodes() stays the reference. The two only differ where compare_nodes()
+    is not a consistent ordering, ie 'index.html' vs 'index.json' (both sort first, so
+    the result depended on the input order, here it is by name), and dirs with and
+    without a version in the same parent (here the versions are first).'''
+    is_path = not isinstance(node, IndexNode)
+    default_rank = 0 if is_path and isinstance(node, PathNode) and node.name == 'default' else 1
+
+    if isinstance(node, PathNode) and hasattr(node, 'version'):
+        version_key = (0, _Descending(node.semver))
+    else:
+        version_key = (1,)
+
+    index_rank = 0 if not is_path and node.name in ('index.html', 'index.json') else 1
+
+    return (0 if is_path else 1, default_rank, version_key, index_rank, node.name)
+
+
+by_sort_key = operator.attrgetter('sort_key')
+
+
+def sorted_siblings(node):
+    '''The siblings of node in sort_key order'''
+    return sorted(node.siblings, key=by_sort_key)
+
+
+def sorted_descendants(node):
+    '''Pre-order descendants of node, with each nodes children in sort_key order.
+
+    So listings of a subtree come out the same whatever order its nodes were attached
+    in, ie whether a version was imported in this run or loaded from the snapshot.'''
+    nodes = list(reversed(sorted(node.children, key=by_sort_key)))
+    while nodes:
+        node = nodes.pop()
+        yield node
+        children = node.children
+        if children:
+            nodes.extend(reversed(sorted(children, key=by_sort_key)))
 
 
 def compare_nodes(a, b):
@@ -527,7 +1400,7 @@ def compare_nodes(a, b):
         #          semantic_version.Version(a.version) < semantic_version.Version(b.version))
 
         # Note that we want higher versions shown earlier, so this is flipped
-        return semantic_version.Version(a.version) > semantic_version.Version(b.version)
+        return a.semver > b.semver
 
     # index files before other files
     if isinstance(a, IndexNode) and isinstance(b, IndexNode):
@@ -542,6 +1415,8 @@ def compare_nodes(a, b):
 
 NODE_TYPE_MAP = {
     'PathNode': PathNode,
+    'CollectionVersionNode': CollectionVersionNode,
+    'DocsBlobNode': DocsBlobNode,
     'CollectionIndexJsonNode': CollectionIndexJsonNode,
     'FsSymlinkNode': FsSymlinkNode,
     'HighestVersionFsSymlinkNode': HighestVersionFsSymlinkNode,
@@ -1,33 +1,43 @@
+import collections
 import datetime
+import functools
 import glob
+import hashlib
+import itertools
 import logging
+import mimetypes
 import multiprocessing
 import os
 import os.path
 import pathlib
-import tarfile
+import queue
 import tempfile
+import time
 
 from anytree import (
-    Resolver,
     ResolverError,
 )
-import anytree.search
 
 import attr
 
 import jinja2
 
-from galaxy_importer.config import Config
+from galaxy_importer import exceptions as importer_exc
+from galaxy_importer import schema
+from galaxy_importer.utils import markup as markup_utils
 
+from . import archive
+from . import cache
+from . import checksums
+from . import fingerprints
 from . import loader
 from . import models
 from .nodes import (
     CollectionIndexJsonNode,
+    CollectionVersionNode,
     HighestVersionFsSymlinkNode,
     IndexNode,
     IndexArtifactNode,
-    IndexBytesNode,
     IndexFileListNode,
     IndexHtmlNode,
     IndexJinjaNode,
@@ -40,6 +50,7 @@ from .nodes import (
 
 from . import snapshot
 from . import utils
+from . import workers
 
 
 log = logging.getLogger(__name__)
@@ -117,6 +128,10 @@ class WarehouseTreeReader(TreeReader):
     def __init__(self, warehouse_info, config_info):
         self.warehouse_info = warehouse_info
         self.config_info = config_info
+        self._collection_artifacts_reader = None
+        self._snapshot_node = None
+        self._snapshot_preloaded = False
+        self._snapshot_sha256 = None
         super().__init__()
 
     def setup_jinja_env(self):
@@ -128,10 +143,19 @@ class WarehouseTreeReader(TreeReader):
 
     def populate(self, parent_node):
         if self.warehouse_info.incremental:
-            wh_node = self.load_snapshot()
+            wh_node = self._snapshot_node if self._snapshot_preloaded else self.load_snapshot()
             if wh_node:
                 wh_node.parent = parent_node
-                log.debug('snapshot tree:\n%s', utils.render_tree(wh_node))
+                stamp = self.previous_export_stamp(wh_node)
+                previous_sha256s = self.previous_output_sha256s(wh_node, stamp) if stamp else None
+                if previous_sha256s is not None:
+                    log.debug('%s was exported from this snapshot, only changes will be exported', wh_node.pth)
+                    wh_node.mark_clean(previous_sha256s=previous_sha256s)
+                    self.mark_template_changes(wh_node, stamp.get('template_fingerprints', {}))
+                elif stamp is not None:
+                    log.warning('The output of %s is not the one last exported, exporting all of it', wh_node.fs_pth)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('snapshot tree:\n%s', utils.render_tree(wh_node))
 
                 return wh_node
 
@@ -290,56 +314,138 @@ class WarehouseTreeReader(TreeReader):
 
         return wh_node
 
-    def populate_collections(self, wh_node, collection_filenames):
+    def collections_to_import(self, wh_node, collection_filenames):
+        '''Expand collection_filenames and return the paths that need importing, and the names that were removed'''
         log.debug('pre expand collection_filesnames: %s', collection_filenames)
 
         expanded_collection_filenames = list(expand_path_patterns(collection_filenames))
         log.debug('expanded_collection_filenames: %s', expanded_collection_filenames)
 
         added_names_set, deleted_names_set = calculate_warehouse_delta(expanded_collection_filenames, self.warehouse_info, wh_node)
-        # added_collection_filenames = sorted(list([item for item in collection_filenames if item.name in added_names_set]))
         added_collection_filenames = sorted(list([item for item in expanded_collection_filenames if item.name in added_names_set]))
         log.debug('added_collection_filenames: %s', sorted(added_collection_filenames))
         log.debug('added_names_set: %s', sorted(list(added_names_set)))
         log.debug('deleted_names_set: %s', sorted(list(deleted_names_set)))
 
-        collections_loader = load_collections_from_filenames(added_collection_filenames, self.warehouse_info, wh_node)
+        return added_collection_filenames, deleted_names_set
 
-        log.debug('updating collections for warehouse: %s', self.warehouse_info.warehouse_name)
-        # log.debug('render_tree:\n%s', utils.render_tree(base_node))
-        # wh_node = actions.update_collections(wh_node, collections_reader, self.warehouse_info)
-
-        r = Resolver('name')
+    def record_changes(self, wh_node, added_names_set, deleted_names_set, import_failures=None):
+        '''Add an entry to the changes node for the artifacts added, removed, and that failed to import'''
+        import_failures = import_failures or []
 
         changes_path = "changes"
-        changes_node = r.get(wh_node, changes_path)
+        changes_node = wh_node.get_path(changes_path)
         changes_node.changes = getattr(changes_node, 'changes', [])
-        if added_names_set or deleted_names_set:
-            changes_node.changes.append({'added': sorted(list(added_names_set)),
-                                         'removed': sorted(list(deleted_names_set)),
-                                         'date': datetime.datetime.now().isoformat()})
-
-        collection_artifacts_reader = CollectionArtifactTreeReader(self.warehouse_info,
-                                                                   self.config_info,
-                                                                   self.jinja_env)
+        if not (added_names_set or deleted_names_set or import_failures):
+            return
+
+        change = {'added': sorted(list(added_names_set)),
+                  'removed': sorted(list(deleted_names_set)),
+                  'date': datetime.datetime.now().isoformat()}
+        if import_failures:
+            change['failed'] = [{'filename': failure.collection_path.name,
+                                 'reason': failure.reason,
+                                 'attempts': failure.attempts}
+                                for failure in sorted(import_failures, key=lambda failure: failure.collection_path)]
+        changes_node.changes.append(change)
+        changes_node.changed()
+
+    def collection_artifacts_reader(self):
+        if self._collection_artifacts_reader is None:
+            self._collection_artifacts_reader = CollectionArtifactTreeReader(self.warehouse_info,
+                                                                             self.config_info,
+                                                                             self.jinja_env)
+        return self._collection_artifacts_reader
+
+    def populate_collections(self, wh_node, collections_loader):
+        '''Add the LoaderResults from the collections_loader iterable to wh_node'''
+        log.debug('updating collections for warehouse: %s', self.warehouse_info.warehouse_name)
 
-        wh_node = collection_artifacts_reader.populate(wh_node, collections_loader)
+        wh_node = self.collection_artifacts_reader().populate(wh_node, collections_loader)
 
         log.debug('wh_node.pth: %s', wh_node.pth)
 
         return wh_node
 
+    def add_collection(self, wh_node, result):
+        '''Add one LoaderResult to wh_node, returning the nodes only it needs (see CollectionArtifactTreeReader.add_collection)'''
+        return self.collection_artifacts_reader().add_collection(wh_node, result)
+
+    def preload_snapshot(self):
+        '''Load the snapshot ahead of populate(), which is the only part that has to attach it to the tree'''
+        if self.warehouse_info.incremental:
+            self._snapshot_node = self.load_snapshot()
+        self._snapshot_preloaded = True
+
+    def snapshot_dir(self):
+        return os.path.join(self.config_info.app['snapshot_dir'], self.warehouse_info.warehouse_name)
+
+    def export_stamp_path(self):
+        return os.path.join(self.snapshot_dir(), snapshot.EXPORT_STAMP_FILENAME)
+
+    def previous_export_stamp(self, wh_node):
+        '''The stamp of the last export, if the output dir still has everything the loaded snapshot describes'''
+        if self._snapshot_sha256 is None:
+            return None
+        stamp = snapshot.read_export_stamp(self.export_stamp_path())
+        if stamp is None:
+            return None
+        template_fingerprints = stamp.pop('template_fingerprints', {})
+        output_sha256sums = stamp.pop('output_sha256sums', None)
+        if stamp != snapshot.export_stamp(wh_node, self._snapshot_sha256):
+            return None
+        stamp['template_fingerprints'] = template_fingerprints
+        stamp['output_sha256sums'] = output_sha256sums
+        return stamp
+
+    def previous_output_sha256s(self, wh_node, stamp):
+        '''{path: sha256} from the SHA256SUMS in the output of wh_node, if it is the one
+        written with stamp and every file it lists is still there, else None'''
+        sums_node = wh_node.get_child('SHA256SUMS')
+        if sums_node is None or not stamp.get('output_sha256sums'):
+            return None
+        try:
+            if utils.sha256sum_from_path(sums_node.fs_pth) != stamp['output_sha256sums']:
+                return None
+        except FileNotFoundError:
+            return None
+
+        sha256s = sums_node.read_sha256s()
+        for rel_path in sha256s:
+            if not os.path.lexists(os.path.join(wh_node.fs_pth, rel_path)):
+                log.debug('%s is missing from the output', rel_path)
+                return None
+        return sha256s
+
+    def template_fingerprints(self):
+        return fingerprints.for_env(self.jinja_env).fingerprints()
+
+    def mark_template_changes(self, wh_node, previous_fingerprints):
+        '''Mark the nodes rendered from templates that changed since the last export dirty'''
+        changed_templates = fingerprints.for_env(self.jinja_env).changed_templates(previous_fingerprints)
+        if not changed_templates:
+            return
+        log.info('Templates changed since the last export of %s: %s',
+                 wh_node.pth, ', '.join(sorted(changed_templates)))
+        wh_node.mark_templates_changed(changed_templates)
+
+    def unchanged_snapshot_sha256(self, wh_node):
+        '''The sha256 of the loaded snapshot if nothing in wh_node changed since, else None'''
+        if wh_node.needs_export:
+            return None
+        return self._snapshot_sha256
+
     def load_snapshot(self):
         try:
-            snapshot_path = os.path.join(self.config_info.app['snapshot_dir'],
-                                         self.warehouse_info.warehouse_name,
-                                         'SNAPSHOT.json')
+            snapshot_path = os.path.join(self.snapshot_dir(), 'SNAPSHOT.json')
 
             log.debug('Loading snapshot %s', snapshot_path)
-            with open(snapshot_path, 'r') as snapshot_fd:
-                wh_node = snapshot.snapshot_load(snapshot_fd)
-                wh_node._jinja_env = self.jinja_env
-                log.debug('loaded wh_node: %s from %s', wh_node.pth, snapshot_path)
+            with open(snapshot_path, 'rb') as snapshot_fd:
+                b_snapshot = snapshot_fd.read()
+            wh_node = snapshot.snapshot_loads(b_snapshot.decode('utf-8'))
+            wh_node._jinja_env = self.jinja_env
+            self._snapshot_sha256 = hashlib.sha256(b_snapshot).hexdigest()
+            log.debug('loaded wh_node: %s from %s', wh_node.pth, snapshot_path)
             return wh_node
         except FileNotFoundError:
             log.warning('No snapshot file found at %s', snapshot_path)
@@ -356,276 +462,306 @@ class CollectionArtifactTreeReader(TreeReader):
 
     def populate(self, wh_node, collections_loader):
         '''Add/Update the collections nodes from the collections_loader iterable.'''
+        for result in collections_loader:
+            self.add_collection(wh_node, result)
 
-        r = Resolver('name')
+            # TODO: yield a progress?
+        return wh_node
 
+    def add_collection(self, wh_node, result):
+        '''Add the nodes for one LoaderResult to wh_node.
+
+        Returns the new version dir node and artifact node. Nothing else in the tree
+        depends on their contents, so they can be exported as soon as they are added.'''
         server_info = self.warehouse_info.server
 
         wh_name = self.warehouse_info.warehouse_name
         collections_path = "v3/collections"
-        collections_node = r.get(wh_node, collections_path)
+        collections_node = wh_node.get_path(collections_path)
 
         artifacts_collection_warehouse_path = f"v3/artifacts/collections/{wh_name}"
-        artifacts_collection_warehouse_node = r.get(wh_node, artifacts_collection_warehouse_path)
-
-        log.debug("collections_node: %s", collections_node)
-        log.debug("collections_node.pth: %s", collections_node.pth)
+        artifacts_collection_warehouse_node = wh_node.get_path(artifacts_collection_warehouse_path)
 
         # add a content/{dist_base_path}/v3/galaxy_repositories/
         # it's index.json would contain per-galaxy-repo contextual info
         # like the set of collections that are deprecated in that repo.
         # Or it's version/timstamp/serialnumber, size, info about url config for pulp and ansible-galaxy
         # etc
-        updated_collections = []
+        # result, artifact_info, collection_filename = result_tup
+        # log.debug('result: %r', result)
+        # log.debug('artifact_info: %s', result.artifact_info)
 
-        for result in collections_loader:
-            # result, artifact_info, collection_filename = result_tup
-            # log.debug('result: %r', result)
-            # log.debug('artifact_info: %s', result.artifact_info)
-
-            namespace = result.metadata.namespace
-            name = result.metadata.name
-            version = result.metadata.version
-
-            log.debug('handling collection %s.%s.%s', namespace, name, version)
-
-            # We only want one node for each warehouse/{namespace} and
-            # {warehouse}/{namespace}/{name}
-            # /content/{warehouse}/v3/collections/{namespace}/
-            namespace_node = PathNode(namespace)
-            namespace_node = collections_node.get_or_add_child(namespace_node)
-
-            # /content/{warehouse}/v3/collections/{namespace}/index.html
-            namespace_index_html_node = IndexHtmlNode("index.html")
-            namespace_node.get_or_add_child(namespace_index_html_node)
-
-            # /content/{warehouse}/v3/collections/{namespace}/index.json
-            namespace_index_json_node = ListIndexJsonNode("index.json",
-                                                          _item_type='PathNode')
-            namespace_node.get_or_add_child(namespace_index_json_node)
-
-            collection_label = f"{result.metadata.namespace}.{result.metadata.name}"
-
-            # /content/{warehouse}/v3/collections/{namespace}/{name}/
-            name_node = namespace_node.get_or_add_child(PathNode(name,
-                                                                 collection_label=collection_label))
-
-            try:
-                r.get(name_node, "index.html")
-            except ResolverError:
-                IndexHtmlNode("index.html",
-                              parent=name_node,
-                              )
-
-            # /v3/collections/{namespace}/{collection_name}/versions/
-            try:
-                versions_subdir_node = r.get(name_node, 'versions')
-            except ResolverError:
-                versions_subdir_node = PathNode("versions",
-                                                parent=name_node,
-                                                )
-
-
-            # /v3/collections/{namespace}/{collection_name}/versions/index.html
-            try:
-                # node already created
-                r.get(versions_subdir_node, 'index.html')
-            except ResolverError:
-                IndexHtmlNode("index.html",
-                              parent=versions_subdir_node,
-                              template_name="collection_versions.html.j2",
-                              )
-
-            # /v3/collections/{namespace}/index.json
-            try:
-                r.get(name_node, "index.json")
-            except ResolverError:
-                CollectionIndexJsonNode("index.json",
-                                        parent=name_node,
-                                        versions_url=versions_subdir_node.url_pth)
-
-            # /v3/collections/{namespace}/{collection_name}/versions/index.json
-            try:
-                # node already created
-                r.get(versions_subdir_node, 'index.json')
-            except ResolverError:
-                VersionsIndexJsonNode("index.json",
-                                      parent=versions_subdir_node,
-                                      )
-
-            download_url = utils.urljoin(server_info.url,
-                                         artifacts_collection_warehouse_node.url_pth,
-                                         result.artifact_info.filename)
-
-            log.debug('download_url: %s', download_url)
-            log.debug('server_info.url: |%s|, warehouse_node.url_path: |%s|, art.filename: |%s|',
-                      server_info.url, artifacts_collection_warehouse_node.url_pth, result.artifact_info.filename)
-
-            # /v3/collections/{namespace}/{collection_name}/versions/{version}
-            version_subdir_node = \
-                PathNode(version,
-                         parent=versions_subdir_node,
-                         # nsnv='%s-%s' % (result.metadata.label, version),
-                         collection_data=result,
-                         metadata=attr.asdict(result.metadata),
-                         namespace=result.metadata.namespace,
-                         collection=result.metadata.name,
-                         collection_label=f"{result.metadata.namespace}.{result.metadata.name}",
-                         imported_artifact=True,
-                         version=result.metadata.version,
-                         artifact_info=result.artifact_info,
-                         artifact=attr.asdict(result.artifact_info),
-                         artifact_file_basename=result.artifact_info.filename,
-                         mtime=result.artifact_info.mtime,
-                         download_url=download_url)
-
-            updated_collections.append(version_subdir_node)
-
-            # Point {namespace}/{name} symlinkt to "default" version of the versions in versions_subdir_node
-            try:
-                r.get(versions_subdir_node, 'default')
-            except ResolverError:
-                default_version_symlink_node = \
-                    HighestVersionFsSymlinkNode("default",
-                                                parent=versions_subdir_node,
-                                                # _versions_subdir_node=versions_subdir_node,
-                                                # _target_node_fs_pth=versions_subdir_node.fs_pth,
-                                                _target_is_directory=True)
-                log.debug('default_version_symlink_node: %s', default_version_symlink_node)
-
-            # /v3/collections/{namespace}/{collection_name}/versions/{version}/index.json
-            IndexJsonNode("index.json",
-                          parent=version_subdir_node,
-                          download_url=download_url,
-                          namespace={'name': result.metadata.namespace},
-                          collection={'name': result.metadata.name},
-                          version=result.metadata.version,
-                          metadata=attr.asdict(result.metadata),
-                          artifact=attr.asdict(result.artifact_info),
-                          )
+        namespace = result.metadata.namespace
+        name = result.metadata.name
+        version = result.metadata.version
 
-            # /v3/collections/{namespace}/{collection_name}/versions/{version}/README.html
-            IndexHtmlNode("README.html",
-                          parent=version_subdir_node,
-                          template_name="README.html.j2",
-                          body_html=result.docs_blob.collection_readme.html,
-                          )
+        log.debug('handling collection %s.%s.%s', namespace, name, version)
+
+        # We only want one node for each warehouse/{namespace} and
+        # {warehouse}/{namespace}/{name}
+        # /content/{warehouse}/v3/collections/{namespace}/
+        namespace_node = PathNode(namespace)
+        namespace_node = collections_node.get_or_add_child(namespace_node)
 
-            # /v3/collections/{namespace}/{collection_name}/versions/{version}/index.html
+        # /content/{warehouse}/v3/collections/{namespace}/index.html
+        namespace_index_html_node = IndexHtmlNode("index.html")
+        namespace_node.get_or_add_child(namespace_index_html_node)
+
+        # /content/{warehouse}/v3/collections/{namespace}/index.json
+        namespace_index_json_node = ListIndexJsonNode("index.json",
+                                                      _item_type='PathNode')
+        namespace_node.get_or_add_child(namespace_index_json_node)
+
+        collection_label = f"{result.metadata.namespace}.{result.metadata.name}"
+
+        # /content/{warehouse}/v3/collections/{namespace}/{name}/
+        name_node = namespace_node.get_or_add_child(PathNode(name,
+                                                             collection_label=collection_label))
+
+        if name_node.get_child("index.html") is None:
             IndexHtmlNode("index.html",
-                          parent=version_subdir_node,
-                          template_name="collection_version.html.j2",
+                          parent=name_node,
                           )
 
-            # /v3/collections/{namespace}/{collection_name}/versions/<version>/docs_blob/
-            try:
-                version_subdir_docs_blob_subdir_node = r.get(version_subdir_node, 'docs_blob')
-            except ResolverError:
-                version_subdir_docs_blob_subdir_node = PathNode("docs_blob",
-                                                                parent=version_subdir_node,
-                                                                )
-
-            # log.debug('result.docs_blob: %s', result.docs_blob)
-            # /v3/collections/{namespace}/{collection_name}/versions/{version}/docs_blob/index.json
-            IndexJsonNode("index.json",
-                          parent=version_subdir_docs_blob_subdir_node,
-                          **attr.asdict(result.docs_blob))
-
-            # /v3/collections/{namespace}/{collection_name}/versions/{version}/docs_blob/index.html
+        # /v3/collections/{namespace}/{collection_name}/versions/
+        versions_subdir_node = name_node.get_child('versions')
+        if versions_subdir_node is None:
+            versions_subdir_node = PathNode("versions",
+                                            parent=name_node,
+                                            )
+
+
+        # /v3/collections/{namespace}/{collection_name}/versions/index.html
+        if versions_subdir_node.get_child('index.html') is None:
             IndexHtmlNode("index.html",
-                          parent=version_subdir_docs_blob_subdir_node,
-                          template_name="collection_version_docs_blob.html.j2",
-                          docs_blob=attr.asdict(result.docs_blob),
+                          parent=versions_subdir_node,
+                          template_name="collection_versions.html.j2",
                           )
 
-            # /v3/collections/{namespace}/{collection_name}/versions/{version}/MANIFEST.json
-            IndexBytesNode("MANIFEST.json",
-                           parent=version_subdir_node,
-                           b_filecontents=result.b_manifest)
-
-            # /v3/collections/{namespace}/{collection_name}/versions/{version}/FILES.json
-            # (or whatever files_manifest_filename points to)
-            IndexBytesNode(result.file_manifest_filename,
-                           parent=version_subdir_node,
-                           b_filecontents=result.b_file_manifest)
-
-            # Add the artifact file entry into the cousin 'artifacts' branch for download
-            # /v3/artifacts/collections/{warehouse_name}/{namespace}-{name}.{version}.tar.gz
-            IndexArtifactNode(result.artifact_info.filename,
-                              parent=artifacts_collection_warehouse_node,
-                              collection_filename=result.artifact_info.full_path,
-                              file_size=result.artifact_info.size,
-                              mtime=result.artifact_info.mtime,
-                              )
+        # /v3/collections/{namespace}/index.json
+        if name_node.get_child("index.json") is None:
+            CollectionIndexJsonNode("index.json",
+                                    parent=name_node,
+                                    versions_url=versions_subdir_node.url_pth)
 
-            # TODO: yield a progress?
-        return wh_node
+        # /v3/collections/{namespace}/{collection_name}/versions/index.json
+        if versions_subdir_node.get_child('index.json') is None:
+            VersionsIndexJsonNode("index.json",
+                                  parent=versions_subdir_node,
+                                  )
 
+        download_url = utils.urljoin(server_info.url,
+                                     artifacts_collection_warehouse_node.url_pth,
+                                     result.artifact_info.filename)
+
+        log.debug('download_url: %s', download_url)
+        log.debug('server_info.url: |%s|, warehouse_node.url_path: |%s|, art.filename: |%s|',
+                  server_info.url, artifacts_collection_warehouse_node.url_pth, result.artifact_info.filename)
+
+        # /v3/collections/{namespace}/{collection_name}/versions/{version}
+        # The files in the version dir (index.json, docs_blob/, MANIFEST.json, etc)
+        # are built from its data by CollectionVersionNode when they are exported.
+        version_subdir_node = \
+            CollectionVersionNode(version,
+                                  parent=versions_subdir_node,
+                                  # nsnv='%s-%s' % (result.metadata.label, version),
+                                  collection_data=models.CollectionVersionData.from_loader_result(result),
+                                  namespace=result.metadata.namespace,
+                                  collection=result.metadata.name,
+                                  collection_label=f"{result.metadata.namespace}.{result.metadata.name}",
+                                  imported_artifact=True,
+                                  version=result.metadata.version,
+                                  artifact_file_basename=result.artifact_info.filename,
+                                  mtime=result.artifact_info.mtime,
+                                  download_url=download_url)
+
+        # Point {namespace}/{name} symlinkt to "default" version of the versions in versions_subdir_node
+        if versions_subdir_node.get_child('default') is None:
+            default_version_symlink_node = \
+                HighestVersionFsSymlinkNode("default",
+                                            parent=versions_subdir_node,
+                                            # _versions_subdir_node=versions_subdir_node,
+                                            # _target_node_fs_pth=versions_subdir_node.fs_pth,
+                                            _target_is_directory=True)
+            log.debug('default_version_symlink_node: %s', default_version_symlink_node)
+
+        # Add the artifact file entry into the cousin 'artifacts' branch for download
+        # /v3/artifacts/collections/{warehouse_name}/{namespace}-{name}.{version}.tar.gz
+        artifact_node = IndexArtifactNode(result.artifact_info.filename,
+                                          parent=artifacts_collection_warehouse_node,
+                                          collection_filename=result.artifact_info.full_path,
+                                          file_size=result.artifact_info.size,
+                                          mtime=result.artifact_info.mtime,
+                                          sha256=result.artifact_info.sha256,
+                                          )
+
+        return version_subdir_node, artifact_node
+
+
+def import_collection(collection_path, warehouse_info, importer_info):
+    '''Return the LoaderResult for collection_path from the import cache, or load_collection() it.
+
+    An artifact whose stat matches a cached one is not read at all. Otherwise its sha256
+    comes from the one read load_collection() does, so an identical artifact at a new
+    path or mtime is still read, and in full import_mode extracted, but not imported.'''
+    if not importer_info.cache_dir:
+        return load_collection(collection_path, warehouse_info, importer_info)
+
+    import_cache = cache.ContentCache(importer_info.cache_dir, max_size=importer_info.cache_max_size)
+
+    # Avoid even reading the artifact if it has not changed since it was last seen
+    stat_key = cache.stat_cache_key(collection_path)
+    artifact_sha256 = import_cache.get(stat_key)
+    if artifact_sha256 is not None:
+        loader_result = import_cache.get(cache.import_cache_key(artifact_sha256, warehouse_info))
+        if loader_result is not None:
+            log.debug('import cache hit for %s (%s)', collection_path, artifact_sha256)
+            # The same artifact may have been imported from another path
+            artifact_info = archive.artifact_info_from_stat(collection_path, artifact_sha256,
+                                                            os.stat(collection_path))
+            return attr.evolve(loader_result, artifact_info=artifact_info)
+
+    cache_hit = False
+
+    def cached_result(artifact_info):
+        # The sha256 is only known at the end of the read the import does anyway. Hashing in a
+        # pass of its own first would skip the extraction on a hit, but read every new artifact twice.
+        nonlocal cache_hit
+        import_cache.put(stat_key, artifact_info.sha256)
+        loader_result = import_cache.get(cache.import_cache_key(artifact_info.sha256, warehouse_info))
+        if loader_result is None:
+            return None
+        log.debug('import cache hit for %s (%s)', collection_path, artifact_info.sha256)
+        cache_hit = True
+        return attr.evolve(loader_result, artifact_info=artifact_info)
+
+    loader_result = load_collection(collection_path, warehouse_info, importer_info, cached_result=cached_result)
+    if not cache_hit:
+        import_cache.put(cache.import_cache_key(loader_result.artifact_info.sha256, warehouse_info), loader_result)
+
+    return loader_result
+
+
+def load_collection(collection_path, warehouse_info, importer_info=None, cached_result=None):
+    '''Import collection_path.
+
+    cached_result is called with the ArtifactInfo as soon as the artifact has been read,
+    and if it returns a LoaderResult, that is returned instead of running the importer.
+    In full import_mode the artifact has already been extracted by then.'''
+    if warehouse_info.import_mode == 'metadata':
+        return load_collection_metadata(collection_path, warehouse_info, cached_result=cached_result)
 
-def load_collection(collection_path, warehouse_info):
     log.debug('loading CollectionArtifact from %s', collection_path)
 
     with tempfile.TemporaryDirectory() as tmp_dir:
-        with open(collection_path, 'rb') as b_collection_fo:
-            sub_path = 'ansible_collections/placeholder_namespace/placeholder_name'
-            extract_dir = os.path.join(tmp_dir, sub_path)
-            with tarfile.open(fileobj=b_collection_fo, mode='r') as pkg_tar:
-                pkg_tar.extractall(extract_dir)
-            dummy_logger = logging.getLogger(__name__ + '._dummy')
-
-            sha256 = utils.sha256sum_from_path(collection_path)
-            file_size = os.path.getsize(collection_path)
-            mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(collection_path)).isoformat()
-
-            artifact_info = models.ArtifactInfo(filename=os.path.basename(collection_path),
-                                                full_path=collection_path,
-                                                sha256=sha256,
-                                                mtime=mtime,
-                                                size=file_size)
-
-            cfg = Config(config_data=warehouse_info.galaxy_importer_config)
-            collection_loader = loader.CollectionAndManifestLoader(extract_dir,
-                                                                   str(collection_path),
-                                                                   cfg=cfg,
-                                                                   logger=dummy_logger)
-            import_result = collection_loader.load()
-
-            loader_result = models.LoaderResult(metadata=import_result.metadata,
-                                                docs_blob=import_result.docs_blob,
-                                                contents=import_result.docs_blob,
-                                                artifact_info=artifact_info,
-                                                b_file_manifest=collection_loader.b_file_manifest,
-                                                b_manifest=collection_loader.b_manifest,
-                                                file_manifest_filename=collection_loader.file_manifest_filename,
-                                                )
-
+        sub_path = 'ansible_collections/placeholder_namespace/placeholder_name'
+        extract_dir = os.path.join(tmp_dir, sub_path)
+
+        # One pass over the artifact gets the sha256sum, size, MANIFEST.json and FILES.json bytes
+        # and extracts only the members the import needs.
+        skip_prefixes = archive.import_skip_prefixes(warehouse_info.galaxy_importer_config)
+        artifact_contents = archive.read_artifact(collection_path,
+                                                  extract_dir=extract_dir,
+                                                  skip_prefixes=skip_prefixes)
+        if cached_result is not None:
+            loader_result = cached_result(artifact_contents.artifact_info)
+            if loader_result is not None:
+                return loader_result
+
+        dummy_logger = logging.getLogger(__name__ + '._dummy')
+
+        doc_cache = None
+        if importer_info and importer_info.doc_cache_dir:
+            doc_cache = cache.ContentCache(importer_info.doc_cache_dir, max_size=importer_info.doc_cache_max_size)
+
+        cfg = workers.importer_config(warehouse_info.galaxy_importer_config)
+        collection_loader = loader.CollectionAndManifestLoader(extract_dir,
+                                                               str(collection_path),
+                                                               cfg=cfg,
+                                                               logger=dummy_logger,
+                                                               b_manifest=artifact_contents.b_manifest,
+                                                               b_file_manifest=artifact_contents.b_file_manifest,
+                                                               doc_cache=doc_cache)
+        import_result = collection_loader.load()
+
+        loader_result = models.LoaderResult(metadata=import_result.metadata,
+                                            docs_blob=import_result.docs_blob,
+                                            contents=import_result.docs_blob,
+                                            artifact_info=artifact_contents.artifact_info,
+                                            b_file_manifest=collection_loader.b_file_manifest,
+                                            b_manifest=collection_loader.b_manifest,
+                                            file_manifest_filename=collection_loader.file_manifest_filename,
+                                            )
+
+        return loader_result
+
+
+def load_collection_metadata(collection_path, warehouse_info, cached_result=None):
+    '''Build a LoaderResult from MANIFEST.json, the file manifest, and the README only.
+
+    This never extracts the artifact or runs the galaxy_importer CollectionLoader, so
+    there is no ansible-doc/lint/etc. The docs_blob only includes the collection README.'''
+    log.debug('loading CollectionArtifact metadata from %s', collection_path)
+
+    artifact_contents = archive.read_artifact(collection_path)
+    if cached_result is not None:
+        loader_result = cached_result(artifact_contents.artifact_info)
+        if loader_result is not None:
             return loader_result
 
+    if artifact_contents.b_manifest is None:
+        raise importer_exc.ManifestNotFound(f'No manifest file ("MANIFEST.json") found in collection from {collection_path}')
+
+    manifest = loader.parse_manifest(artifact_contents.b_manifest, str(collection_path))
+    metadata = manifest.collection_info
+
+    collection_readme = schema.RenderedDocFile()
+    b_readme = artifact_contents.members.get(metadata.readme)
+    if b_readme is not None:
+        mimetype, _encoding = mimetypes.guess_type(metadata.readme)
+        readme_doc_file = markup_utils.DocFile(name=metadata.readme,
+                                               text=b_readme.decode('utf-8'),
+                                               mimetype=mimetype,
+                                               hash=None)
+        collection_readme = schema.RenderedDocFile(name=metadata.readme,
+                                                   html=markup_utils.get_html(readme_doc_file))
+
+    docs_blob = schema.DocsBlob(collection_readme=collection_readme)
+
+    loader_result = models.LoaderResult(metadata=metadata,
+                                        docs_blob=docs_blob,
+                                        contents=docs_blob,
+                                        artifact_info=artifact_contents.artifact_info,
+                                        b_file_manifest=artifact_contents.b_file_manifest,
+                                        b_manifest=artifact_contents.b_manifest,
+                                        file_manifest_filename=artifact_contents.file_manifest_filename,
+                                        )
+
+    return loader_result
+
 
 def calculate_warehouse_delta(collection_filenames, warehouse_info, wh_node):
-    r = Resolver("name")
     artifacts_collection_warehouse_path = f"v3/artifacts/collections/{warehouse_info.warehouse_name}"
 
     try:
-        artifacts_collection_warehouse_node = r.get(wh_node, artifacts_collection_warehouse_path)
+        artifacts_collection_warehouse_node = wh_node.get_path(artifacts_collection_warehouse_path)
     except ResolverError as exc:
         log.exception(exc)
         raise
 
     import pprint
     pf = pprint.pformat
-    log.debug('tree:\n%s', utils.render_tree(wh_node))
-    log.debug('artifacts_collection_warehouse_node: %s', pf(artifacts_collection_warehouse_node))
-    log.debug('artifacts_collection_warehouse_node.path: %s', artifacts_collection_warehouse_node.path)
-    log.debug('artifacts_collection_warehouse_node.children: %s', pf(artifacts_collection_warehouse_node.children))
-
-    artifact_nodes = anytree.search.findall_by_attr(artifacts_collection_warehouse_node, "IndexArtifactNode", name="_node_type")
 
-    log.debug('artifact_nodes:\n%s', pprint.pformat([a for a in artifact_nodes]))
+    artifact_nodes = artifacts_collection_warehouse_node.find_by_type("IndexArtifactNode")
 
-    all_artifact_nodes = anytree.search.findall_by_attr(wh_node,
-                                                        "IndexArtifactNode", name="_node_type")
-    log.debug('all_artifact_nodes:\n%s', pprint.pformat([a for a in all_artifact_nodes]))
+    # rendering the whole tree is expensive, so only when it will be logged
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('tree:\n%s', utils.render_tree(wh_node))
+        log.debug('artifacts_collection_warehouse_node: %s', pf(artifacts_collection_warehouse_node))
+        log.debug('artifacts_collection_warehouse_node.path: %s', artifacts_collection_warehouse_node.path)
+        log.debug('artifacts_collection_warehouse_node.children: %s', pf(artifacts_collection_warehouse_node.children))
+        log.debug('artifact_nodes:\n%s', pprint.pformat([a for a in artifact_nodes]))
+        log.debug('all_artifact_nodes:\n%s', pprint.pformat([a for a in wh_node.find_by_type("IndexArtifactNode")]))
 
     previous_existing_paths = [pathlib.Path(y.collection_filename) for y in artifact_nodes]
     previous_existing_basenames = [x.name for x in previous_existing_paths]
@@ -667,29 +803,209 @@ def expand_path_patterns(path_patterns):
             yield pathlib.Path(path).resolve()
 
 
-# helper for mp.Pool.imap_async since it only takes one arg
-def collection_paths(filenames, wh_info):
-    for filename in filenames:
-        yield filename, wh_info
-
-
-def load_collection_tuple(path_and_info):
-    return load_collection(path_and_info[0], path_and_info[1])
-
-
-def load_collections_from_filenames(collection_filenames, warehouse_info, wh_node):
-
-    #    filtered_collection_filenames = filter_artifacts_already_in_tree(expand_path_patterns(collection_filenames), warehouse_info, wh_node)
-
-    with multiprocessing.Pool() as pool:
-        import_iterator = pool.imap_unordered(load_collection_tuple,
-                                              collection_paths(collection_filenames, warehouse_info),
-                                              chunksize=1)
-
-        pool.close()
-
-        for import_result in import_iterator:
-            log.debug('yielding %s', import_result.artifact_info.filename)
-            yield import_result
-
-        pool.join()
+def plan_import_jobs(import_requests, checksum_engine=None):
+    '''Group the artifacts requested by every warehouse into ImportJobs.
+
+    import_requests is an iterable of (warehouse_info, collection_paths). Requests
+    with the same import config and either the same resolved path or the same
+    contents share one ImportJob, so each artifact is only imported once per run.
+    Artifacts that need comparing are hashed together on checksum_engine.'''
+    checksum_engine = checksum_engine or checksums.default_engine
+    jobs = {}
+    for warehouse_info, collection_paths in import_requests:
+        config_fingerprint = cache.import_config_fingerprint(warehouse_info)
+        for collection_path in collection_paths:
+            collection_path = pathlib.Path(collection_path).resolve()
+            job_key = (config_fingerprint, collection_path)
+            if job_key not in jobs:
+                jobs[job_key] = models.ImportJob(collection_path=collection_path,
+                                                 warehouse_info=warehouse_info)
+            jobs[job_key].destinations.append((warehouse_info.warehouse_name, collection_path))
+
+    # Different paths can only have the same contents if they are the same size,
+    # so only those need to be hashed.
+    by_size = {}
+    for (config_fingerprint, collection_path), job in jobs.items():
+        size_key = (config_fingerprint, os.path.getsize(collection_path))
+        by_size.setdefault(size_key, []).append(job)
+
+    sha256s = checksum_engine.sha256sums([job.collection_path
+                                          for same_size_jobs in by_size.values() if len(same_size_jobs) > 1
+                                          for job in same_size_jobs])
+
+    import_jobs = []
+    for (config_fingerprint, _size), same_size_jobs in by_size.items():
+        if len(same_size_jobs) == 1:
+            import_jobs.extend(same_size_jobs)
+            continue
+
+        by_sha256 = {}
+        for job in same_size_jobs:
+            sha256 = sha256s[job.collection_path]
+            if sha256 in by_sha256:
+                log.debug('%s has the same contents as %s, importing once',
+                          job.collection_path, by_sha256[sha256].collection_path)
+                by_sha256[sha256].destinations.extend(job.destinations)
+                continue
+            by_sha256[sha256] = job
+        import_jobs.extend(by_sha256.values())
+
+    return import_jobs
+
+
+def load_import_jobs(indexed_jobs_and_importer_info):
+    '''Pool worker that imports a chunk of (index, ImportJob)
+
+    Returns a list of (index, LoaderResult), with an ImportFailure in place of the
+    LoaderResult for anything that raised or ran longer than importer_info.timeout.'''
+    indexed_jobs, importer_info = indexed_jobs_and_importer_info
+
+    results = []
+    for index, import_job in indexed_jobs:
+        try:
+            with workers.time_limit(importer_info.timeout):
+                result = import_collection(import_job.collection_path, import_job.warehouse_info, importer_info)
+        except (Exception, workers.ImportTimeout) as exc:
+            mplog.warning('Failed to import %s: %s', import_job.collection_path, exc)
+            result = models.ImportFailure(collection_path=import_job.collection_path,
+                                          reason=f'{exc.__class__.__name__}: {exc}')
+        results.append((index, result))
+    return results
+
+
+def run_import_jobs(pool, import_jobs, importer_info):
+    '''Run import_jobs on pool, yielding (ImportJob, LoaderResult or ImportFailure) as they finish.
+
+    Only as many chunks as there are workers are in flight at once, so a chunk
+    starts as soon as it is submitted and can be given a deadline. A chunk that
+    misses its deadline is given up on and its worker slot is not reused. Failed
+    imports are retried up to importer_info.retries times.'''
+    results_queue = queue.Queue()
+    chunk_ids = itertools.count()
+    attempts = collections.Counter()
+    pending = {}
+
+    chunksize = importer_info.chunksize
+    hard_timeout = None
+    if importer_info.timeout:
+        hard_timeout = importer_info.timeout + workers.HARD_TIMEOUT_GRACE
+
+    waiting = list(enumerate(import_jobs))
+    waiting.reverse()
+    slots = workers.pool_size(importer_info)
+
+    def submit():
+        while waiting and len(pending) < slots:
+            chunk = [waiting.pop() for _i in range(min(chunksize, len(waiting)))]
+            chunk_id = next(chunk_ids)
+            deadline = None
+            if hard_timeout:
+                deadline = time.monotonic() + hard_timeout * len(chunk)
+            pending[chunk_id] = (deadline, chunk)
+            pool.apply_async(load_import_jobs, ((chunk, importer_info),),
+                             callback=functools.partial(_put_result, results_queue, chunk_id),
+                             error_callback=functools.partial(_put_result, results_queue, chunk_id))
+
+    def wait_timeout():
+        deadlines = [deadline for deadline, _chunk in pending.values() if deadline is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    submit()
+    while pending:
+        try:
+            chunk_id, chunk_results = results_queue.get(timeout=wait_timeout())
+        except queue.Empty:
+            now = time.monotonic()
+            chunk_results = []
+            for chunk_id, (deadline, chunk) in list(pending.items()):
+                if deadline is None or deadline > now:
+                    continue
+                del pending[chunk_id]
+                slots -= 1
+                log.warning('No import result after %ss for %s, giving up on its worker',
+                            hard_timeout, [str(import_job.collection_path) for _index, import_job in chunk])
+                chunk_results.extend((index, models.ImportFailure(collection_path=import_job.collection_path,
+                                                                  reason=f'no result after {hard_timeout}s'))
+                                     for index, import_job in chunk)
+            if slots < 1 and waiting:
+                log.error('Every import worker is stuck, skipping %s remaining imports', len(waiting))
+                chunk_results.extend((index, models.ImportFailure(collection_path=import_job.collection_path,
+                                                                  reason='no import workers left'))
+                                     for index, import_job in waiting)
+                waiting.clear()
+        else:
+            if chunk_id not in pending:
+                # a late result for a chunk that was already given up on
+                continue
+            _deadline, chunk = pending.pop(chunk_id)
+            if isinstance(chunk_results, BaseException):
+                chunk_results = [(index, models.ImportFailure(collection_path=import_job.collection_path,
+                                                              reason=f'{chunk_results.__class__.__name__}: {chunk_results}'))
+                                 for index, import_job in chunk]
+
+        for index, result in chunk_results:
+            import_job = import_jobs[index]
+            attempts[index] += 1
+            if isinstance(result, models.ImportFailure):
+                if attempts[index] <= importer_info.retries and slots > 0:
+                    log.info('Retrying import of %s after: %s', import_job.collection_path, result.reason)
+                    waiting.append((index, import_job))
+                    continue
+                result = attr.evolve(result, attempts=attempts[index])
+            yield import_job, result
+
+        submit()
+
+
+def _put_result(results_queue, chunk_id, chunk_results):
+    results_queue.put((chunk_id, chunk_results))
+
+
+def import_collections(import_requests, importer_info, pool=None, checksum_engine=None):
+    '''Import every unique artifact from import_requests once, in parallel.
+
+    Yields a (warehouse_name, LoaderResult) for every warehouse that requested each
+    artifact, with the artifact_info for that warehouses path. Artifacts that could
+    not be imported yield an ImportFailure instead. If pool is None, a
+    workers.import_pool is started just for these imports, if there are any.
+    checksum_engine hashes the artifacts that might be the same.'''
+    import_requests = list(import_requests)
+
+    import_jobs = plan_import_jobs(import_requests, checksum_engine=checksum_engine)
+    log.debug('importing %s unique artifacts', len(import_jobs))
+    if not import_jobs:
+        return
+
+    if pool is None:
+        # only the warehouses with something to import, and only if they run galaxy_importer
+        galaxy_importer_configs = workers.importer_configs(import_job.warehouse_info for import_job in import_jobs)
+        with workers.import_pool(importer_info, galaxy_importer_configs) as pool:
+            yield from _import_jobs(pool, import_jobs, importer_info)
+    else:
+        yield from _import_jobs(pool, import_jobs, importer_info)
+
+
+def _import_jobs(pool, import_jobs, importer_info):
+    for import_job, import_result in run_import_jobs(pool, import_jobs, importer_info):
+        for warehouse_name, collection_path in import_job.destinations:
+            if isinstance(import_result, models.ImportFailure):
+                yield warehouse_name, attr.evolve(import_result, collection_path=collection_path)
+                continue
+            yield warehouse_name, result_for_path(import_result, collection_path)
+
+    if importer_info.cache_dir:
+        cache.ContentCache(importer_info.cache_dir, max_size=importer_info.cache_max_size).evict()
+    if importer_info.doc_cache_dir:
+        cache.ContentCache(importer_info.doc_cache_dir, max_size=importer_info.doc_cache_max_size).evict()
+
+
+def result_for_path(loader_result, collection_path):
+    '''Return loader_result with the artifact_info for an identical artifact at collection_path'''
+    if loader_result.artifact_info.full_path == collection_path:
+        return loader_result
+
+    artifact_info = archive.artifact_info_from_stat(collection_path, loader_result.artifact_info.sha256,
+                                                    os.stat(collection_path))
+    return attr.evolve(loader_result, artifact_info=artifact_info)
@@ -1,6 +1,10 @@
+import json
 import logging
 
+import coleslaw
+
 from . import jsonutils
+from . import utils
 
 log = logging.getLogger(__name__)
 
@@ -25,3 +29,43 @@ def snapshot_loads(snapshot_data):
     importer = jsonutils.json_importer()
     node = importer.import_(snapshot_data)
     return node
+
+
+# Written next to SNAPSHOT.json once the tree it describes has been exported
+EXPORT_STAMP_FILENAME = 'EXPORTED.json'
+
+
+def export_stamp(node, snapshot_sha256, template_fingerprints=None):
+    '''Everything that has to be the same for an export of node to still be current.
+
+    template_fingerprints are what the html was rendered with. If they change, only
+    the nodes using the changed templates have to be rendered again.'''
+    stamp = {'snapshot_sha256': snapshot_sha256,
+             'fs_pth': node.fs_pth,
+             'url_pth': node.url_pth,
+             'coleslaw_version': coleslaw.__version__}
+    if template_fingerprints is not None:
+        stamp['template_fingerprints'] = template_fingerprints
+    return stamp
+
+
+def output_sha256sums_sha256(node):
+    '''The sha256 of the SHA256SUMS node wrote in the output, so the next run can
+    tell the output is still the one it exported'''
+    sums_node = node.get_child('SHA256SUMS')
+    if sums_node is None:
+        return None
+    return sums_node.saved_sha256() or utils.sha256sum_from_path(sums_node.fs_pth)
+
+
+def write_export_stamp(stamp_path, stamp):
+    with open(stamp_path, 'w') as stamp_fo:
+        json.dump(stamp, stamp_fo, indent=4)
+
+
+def read_export_stamp(stamp_path):
+    try:
+        with open(stamp_path, 'r') as stamp_fo:
+            return json.load(stamp_fo)
+    except (FileNotFoundError, ValueError):
+        return None
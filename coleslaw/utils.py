@@ -1,20 +1,70 @@
+import contextlib
+import fcntl
 import hashlib
 import logging
+import mmap
+import operator
+import os
+import os.path
 
 from anytree import RenderTree
 
 log = logging.getLogger(__name__)
 
 
-def sha256sum_from_path(filename):
-    block_size = 65536
+# hashlib releases the GIL while hashing big buffers, so threads hash in parallel
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def sha256sum_from_path(path):
+    '''sha256 hexdigest of the file at path, read through mmap in HASH_BLOCK_SIZE pieces'''
     sha256 = hashlib.sha256()
-    with open(filename, 'rb') as fo:
-        for block in iter(lambda: fo.read(block_size), b''):
-            sha256.update(block)
+    with open(path, 'rb') as fo:
+        # empty files can not be mmap'ed
+        if not os.fstat(fo.fileno()).st_size:
+            return sha256.hexdigest()
+        with mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                for offset in range(0, len(view), HASH_BLOCK_SIZE):
+                    sha256.update(view[offset:offset + HASH_BLOCK_SIZE])
     return sha256.hexdigest()
 
 
+def write_if_changed(path, b_contents):
+    '''Write b_contents to path, unless the file already has exactly those contents.
+
+    Unchanged files keep their mtime, so syncs and caches of the output see only real changes.
+    Returns True if the file was written.'''
+    try:
+        with open(path, 'rb') as fo:
+            if os.fstat(fo.fileno()).st_size == len(b_contents) and fo.read() == b_contents:
+                return False
+    except FileNotFoundError:
+        pass
+
+    with open(path, 'wb') as fo:
+        fo.write(b_contents)
+    return True
+
+
+@contextlib.contextmanager
+def lock_file(path):
+    '''Hold an exclusive flock() on path, waiting for whoever else has it'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock_fo:
+        try:
+            fcntl.flock(lock_fo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log.info('Waiting for lock on %s', path)
+            fcntl.flock(lock_fo, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fo, fcntl.LOCK_UN)
+
+
 # From https://stackoverflow.com/a/11326230
 def urljoin(*args):
     """
@@ -36,7 +86,7 @@ def render_tree(root, fields_to_truncate=None, by_attr=None):
     # by_attr = True
 
     def sorter(nodes):
-        return sorted(nodes)
+        return sorted(nodes, key=operator.attrgetter('sort_key'))
 
     render_tree = RenderTree(root, childiter=sorter)
     # render_tree = RenderTree(root)
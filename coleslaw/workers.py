@@ -0,0 +1,120 @@
+import contextlib
+import importlib
+import logging
+import multiprocessing
+import os
+import resource
+import signal
+
+from galaxy_importer.config import Config
+
+from . import cache
+
+log = logging.getLogger(__name__)
+
+# Modules an import needs, imported once per worker instead of on the first import
+WARM_MODULES = ['galaxy_importer.collection',
+                'galaxy_importer.loaders',
+                'galaxy_importer.utils.markup',
+                'jinja2',
+                'coleslaw.loader',
+                'coleslaw.readers',
+                ]
+
+# How long past ImporterInfo.timeout to wait for a worker before giving up on it.
+# Covers imports stuck somewhere SIGALRM can not interrupt.
+HARD_TIMEOUT_GRACE = 60
+
+# galaxy_importer_config fingerprint -> galaxy_importer Config, per worker process
+_importer_configs = {}
+
+
+def importer_config(config_data):
+    '''Return the galaxy_importer Config for config_data, building it only once per process'''
+    key = cache.fingerprint(config_data)
+    if key not in _importer_configs:
+        _importer_configs[key] = Config(config_data=config_data)
+    return _importer_configs[key]
+
+
+class ImportTimeout(BaseException):
+    '''An import ran longer than ImporterInfo.timeout.
+
+    A BaseException so the importers own 'except Exception' handlers do not swallow it.'''
+
+
+def _raise_import_timeout(signum, frame):
+    raise ImportTimeout('import timed out')
+
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    '''Raise ImportTimeout in the main thread if the block runs longer than seconds'''
+    if not seconds:
+        yield
+        return
+
+    previous_handler = signal.signal(signal.SIGALRM, _raise_import_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def pool_size(importer_info):
+    return importer_info.workers or os.cpu_count()
+
+
+def init_import_worker(galaxy_importer_configs, memory_limit=None):
+    '''Pool initializer that does the per process setup up front instead of in the first task'''
+    if memory_limit:
+        # also applies to any ansible-doc etc subprocesses the import runs
+        _soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+
+    for module_name in WARM_MODULES:
+        importlib.import_module(module_name)
+
+    for config_data in galaxy_importer_configs:
+        importer_config(config_data)
+
+
+def unique_configs(galaxy_importer_configs):
+    configs = {}
+    for config_data in galaxy_importer_configs:
+        configs.setdefault(cache.fingerprint(config_data), config_data)
+    return list(configs.values())
+
+
+def importer_configs(warehouse_infos):
+    '''The galaxy_importer_configs an import worker needs for warehouse_infos.
+
+    Warehouses in metadata import_mode never run galaxy_importer, so only the others count.'''
+    return unique_configs(warehouse_info.galaxy_importer_config for warehouse_info in warehouse_infos
+                          if warehouse_info.import_mode != 'metadata')
+
+
+@contextlib.contextmanager
+def import_pool(importer_info, galaxy_importer_configs=None):
+    '''A multiprocessing.Pool for importing artifacts, configured from ImporterInfo.
+
+    The pool is terminated on exit, since a worker stuck past its timeout would
+    never finish a join(). Callers should consume all their results first.'''
+    mp_context = multiprocessing.get_context(importer_info.start_method)
+    processes = pool_size(importer_info)
+
+    log.debug('starting %s import workers (start_method=%s, maxtasksperchild=%s)',
+              processes, mp_context.get_start_method(), importer_info.maxtasksperchild)
+
+    pool = mp_context.Pool(processes=processes,
+                           initializer=init_import_worker,
+                           initargs=(unique_configs(galaxy_importer_configs or []),
+                                     importer_info.memory_limit),
+                           maxtasksperchild=importer_info.maxtasksperchild)
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,35 +1,211 @@
+import concurrent.futures
 import logging
+import multiprocessing
+import operator
+import os
+import os.path
+import threading
 
-import anytree
-
+from . import checksums
 from . import snapshot
 from . import utils
 
 log = logging.getLogger(__name__)
 
+# Set on nodes whose subtree has already been written, so TreeExport.export() skips them
+EXPORTED_ATTR = '_excluded_exported'
+
+by_export_phase = operator.attrgetter('export_phase')
+
+# Leaves handed to an export worker at a time. They are consecutive in export_order(),
+# so mostly from the same subtree.
+EXPORT_BATCH_SIZE = 64
+
+# The root of the tree a process pool is exporting. The workers are forked with a copy
+# of the tree, and find the nodes they are sent by their path from here.
+_export_root = None
+
+
+def check_app_config(app_config):
+    '''Raise ValueError for export settings that can not work together'''
+    workers = app_config.get('export_workers') or 1
+    pool_type = app_config.get('export_pool') or 'process'
+    if pool_type not in checksums.POOL_TYPES:
+        raise ValueError(f'export_pool must be one of {checksums.POOL_TYPES}, not {pool_type!r}')
+    # forking while other threads hold locks can deadlock the workers
+    if workers > 1 and pool_type == 'process' and (app_config.get('parallel_warehouses') or 1) > 1:
+        raise ValueError('export_pool: process can not be used with parallel_warehouses, use export_pool: thread')
+
+
+def mark_exported(node):
+    setattr(node, EXPORTED_ATTR, True)
+
+
+def is_exported(node):
+    return getattr(node, EXPORTED_ATTR, False)
+
+
+def export_order(root_node):
+    '''Pre-order, so every dir is created before anything is saved into it, except
+    that siblings are saved by export_phase.
+
+    Nodes that list or sum other files have a later export_phase, so they are
+    saved after their siblings subtrees are complete on disk. Subtrees with
+    nothing dirty in them are skipped.'''
+    nodes = [root_node]
+    while nodes:
+        node = nodes.pop()
+        if is_exported(node) or not node.needs_export:
+            continue
+        yield node
+        children = node.children
+        if children:
+            nodes.extend(reversed(sorted(children, key=by_export_phase)))
+
+
+def node_path(node, root_node):
+    '''The path of node below root_node, for root_node.get_path()'''
+    names = []
+    while node is not root_node:
+        names.append(node.name)
+        node = node.parent
+    return root_node.separator.join(reversed(names))
+
+
+def _save_nodes(nodes):
+    '''save() each of nodes, and return the sha256 each one saved'''
+    sha256s = []
+    for node in nodes:
+        node.save()
+        sha256s.append(node.saved_sha256())
+    return sha256s
+
+
+def _save_node_paths(paths):
+    return _save_nodes([_export_root.get_path(path) for path in paths])
+
 
 class TreeExport():
-    def __init__(self, root_node):
+    '''Save a tree, serially or on a pool of export workers.
+
+    With more than one worker, the dirs are still made in export_order(), but the
+    leaves under them are saved by the pool, in batches from the same subtree. The
+    aggregate nodes (anything with an export_phase, ie FILES.txt and SHA256SUMS)
+    are saved last, once everything they list is on disk.'''
+
+    def __init__(self, root_node, workers=1, pool_type='process'):
+        if pool_type not in checksums.POOL_TYPES:
+            raise ValueError(f'export_pool must be one of {checksums.POOL_TYPES}, not {pool_type!r}')
         self.root_node = root_node
+        self.workers = workers or 1
+        self.pool_type = pool_type
         self.log = logging.getLogger(__name__ + '.' + self.__class__.__name__)
 
-    # TODO: Replace with a tree walker or iterater
+    @classmethod
+    def from_app_config(cls, root_node, app_config):
+        check_app_config(app_config)
+        return cls(root_node,
+                   workers=app_config.get('export_workers'),
+                   pool_type=app_config.get('export_pool') or 'process')
+
     def export(self):
-        self.log.debug('render_tree:\n%s', utils.render_tree(self.root_node))
+        '''Save every dirty node once, in export_order(), except for subtrees that were already exported'''
+        if not self.root_node.needs_export:
+            log.debug('Nothing has changed under %s', self.root_node)
+            return
 
-        log.debug('Reserving paths for %s', self.root_node)
-        for node in anytree.PreOrderIter(self.root_node):
-            node.reserve()
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('render_tree:\n%s', utils.render_tree(self.root_node))
 
         log.debug('Saving nodes for %s', self.root_node)
-        for node in anytree.PreOrderIter(self.root_node):
-            node.save()
+        if self.workers > 1:
+            saved_nodes = self._save_on_pool()
+        else:
+            saved_nodes = []
+            for node in export_order(self.root_node):
+                if node.is_dirty:
+                    node.save()
+                saved_nodes.append(node)
 
+        # after the loop, since virtual children are only dirty while their parent is
+        for node in saved_nodes:
+            node.mark_saved()
+
+        # virtual children and written payloads are only needed while exporting
+        self.root_node.release()
         return
 
+    def _executor(self):
+        if self.pool_type == 'process':
+            # the workers need the tree, and only a forked worker has it. A fork only copies
+            # the thread doing it, so any lock another thread holds would stay locked.
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                log.warning('Export workers can only be processes where they can be forked, using threads')
+            elif threading.active_count() > 1:
+                log.warning('Export workers can not be forked while other threads are running, using threads')
+            else:
+                return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                              mp_context=multiprocessing.get_context('fork'))
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                     thread_name_prefix='export')
+
+    def _submit(self, executor, nodes):
+        if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+            return executor.submit(_save_node_paths, [node_path(node, self.root_node) for node in nodes])
+        return executor.submit(_save_nodes, nodes)
+
+    def _save_on_pool(self):
+        global _export_root
+
+        log.debug('Saving nodes for %s on %s export %s workers', self.root_node, self.workers, self.pool_type)
+        saved_nodes = []
+        aggregates = []
+        batches = []
+        batch = []
+        _export_root = self.root_node
+        try:
+            with self._executor() as executor:
+                for node in export_order(self.root_node):
+                    saved_nodes.append(node)
+                    if not node.is_dirty:
+                        continue
+                    if node.export_phase:
+                        aggregates.append(node)
+                    elif node.children:
+                        # a dir, made before anything is saved into it
+                        node.save()
+                    else:
+                        batch.append(node)
+                        if len(batch) >= EXPORT_BATCH_SIZE:
+                            batches.append((batch, self._submit(executor, batch)))
+                            batch = []
+                if batch:
+                    batches.append((batch, self._submit(executor, batch)))
+
+                # a process worker saved its own copy of the nodes
+                for batch, future in batches:
+                    for node, sha256 in zip(batch, future.result()):
+                        if sha256 is not None:
+                            node.record_saved_sha256(sha256)
+        finally:
+            _export_root = None
+
+        # still in export_order(), so each is saved after the ones it lists
+        for node in aggregates:
+            node.save()
+        return saved_nodes
+
+    def export_now(self):
+        '''Export the subtree and mark it so a later export of the whole tree skips it'''
+        # the parent dirs are normally reserved earlier in the same export
+        os.makedirs(os.path.dirname(self.root_node.fs_pth), exist_ok=True)
+        self.export()
+        mark_exported(self.root_node)
+
     def snapshot(self, snapshot_path):
+        '''Write the snapshot and return its sha256'''
         log.debug('saving SNAPSHOT.json at %s', snapshot_path)
         with open(snapshot_path, 'w') as snapshot_fo:
             snapshot.snapshot_dump(self.root_node, snapshot_fo)
 
-        return
+        return utils.sha256sum_from_path(snapshot_path)
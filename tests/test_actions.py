@@ -0,0 +1,188 @@
+import hashlib
+import os
+import shutil
+
+from coleslaw import actions
+from coleslaw import workers
+
+from .test_readers import _metadata_artifact
+
+
+def _config_info(tmp_path, warehouse_config=''):
+    config_path = tmp_path / 'coleslaw.yml'
+    config_path.write_text(f'''
+app:
+  output_dir: {tmp_path / 'out'}/
+  url_prefix: example/
+  snapshot_dir: {tmp_path / 'snapshots'}
+warehouse_defaults:
+  server:
+    url: http://localhost/
+  galaxy_importer_config: {{}}
+warehouses:
+  golden:
+    incremental: true
+{warehouse_config}''')
+    return actions.read_config(str(config_path))
+
+
+def _run(config_info):
+    base_node = actions.build_tree(config_info, [])
+    actions.export_tree(config_info, base_node)
+    return base_node
+
+
+def _check_sums(wh_path):
+    '''Every file in the SHA256SUMS of wh_path is there with that sha256, and every file there is in it'''
+    with open(wh_path / 'SHA256SUMS') as sums_fo:
+        sha256s = dict(reversed(line.split('  ', 1)) for line in sums_fo.read().splitlines())
+    for rel_path, sha256 in sha256s.items():
+        with open(wh_path / rel_path, 'rb') as file_fo:
+            assert hashlib.sha256(file_fo.read()).hexdigest() == sha256, rel_path
+    on_disk = set()
+    for dir_path, _dirs, filenames in os.walk(wh_path):
+        on_disk.update(os.path.relpath(os.path.join(dir_path, filename), wh_path) for filename in filenames)
+    assert on_disk - set(sha256s) == {'SHA256SUMS'}
+
+
+def test_incremental_export_rebuilds_deleted_output(tmp_path):
+    config_info = _config_info(tmp_path)
+    wh_path = tmp_path / 'out' / 'content' / 'golden'
+
+    _run(config_info)
+    _run(config_info)
+    _check_sums(wh_path)
+
+    # a dir the SHA256SUMS lists files from
+    shutil.rmtree(wh_path / 'v3' / 'collections')
+    _run(config_info)
+    assert os.path.exists(wh_path / 'v3' / 'collections' / 'index.json')
+    _check_sums(wh_path)
+
+    # all of it
+    shutil.rmtree(tmp_path / 'out')
+    _run(config_info)
+    _check_sums(wh_path)
+
+    # a file, with the SHA256SUMS gone too
+    os.unlink(wh_path / 'v3' / 'index.json')
+    os.unlink(wh_path / 'SHA256SUMS')
+    _run(config_info)
+    assert os.path.exists(wh_path / 'v3' / 'index.json')
+    _check_sums(wh_path)
+
+
+def test_no_import_pool_without_imports(tmp_path, monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError('an import pool was started')
+
+    monkeypatch.setattr(workers, 'import_pool', no_pool)
+    _run(_config_info(tmp_path))
+
+
+def test_locks_are_not_in_the_output(tmp_path):
+    config_info = _config_info(tmp_path)
+    with actions.warehouse_locks(config_info):
+        _run(config_info)
+
+    for dir_path, _dirs, filenames in os.walk(tmp_path / 'out'):
+        assert not [filename for filename in filenames if filename.endswith('.lock')], dir_path
+    assert len(os.listdir(tmp_path / 'snapshots' / 'locks')) == 2
+
+
+def test_incremental_export_renders_changed_templates(tmp_path):
+    (tmp_path / 'colls').mkdir()
+    _metadata_artifact(tmp_path / 'colls' / 'ns-coll-1.0.0.tar.gz')
+    templates_dir = tmp_path / 'templates'
+    templates_dir.mkdir()
+    config_info = _config_info(tmp_path, f'''    import_mode: metadata
+    templates_dir: {templates_dir}
+    collections:
+      - "{tmp_path / 'colls'}/*.tar.gz"
+''')
+    readme_path = tmp_path / 'out' / 'content' / 'golden' / 'v3' / 'collections' / 'ns' / 'coll' / 'versions' / \
+        '1.0.0' / 'README.html'
+
+    _run(config_info)
+    _run(config_info)
+    assert 'first edit' not in readme_path.read_text()
+
+    (templates_dir / 'README.html.j2').write_text('first edit\n')
+    _run(config_info)
+    assert readme_path.read_text() == 'first edit'
+    _check_sums(tmp_path / 'out' / 'content' / 'golden')
+
+    # the stamp of the run before has the new fingerprints, so a second edit is picked up too
+    (templates_dir / 'README.html.j2').write_text('second edit\n')
+    _run(config_info)
+    assert readme_path.read_text() == 'second edit'
+
+
+def _written_since(path, mtime_ns):
+    written = set()
+    for dir_path, _dirs, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dir_path, filename)
+            if os.stat(file_path).st_mtime_ns != mtime_ns:
+                written.add(os.path.relpath(file_path, path))
+    return written
+
+
+def test_template_change_renders_only_its_pages(tmp_path):
+    (tmp_path / 'colls').mkdir()
+    _metadata_artifact(tmp_path / 'colls' / 'ns-coll-1.0.0.tar.gz')
+    templates_dir = tmp_path / 'templates'
+    templates_dir.mkdir()
+    config_info = _config_info(tmp_path, f'''    import_mode: metadata
+    templates_dir: {templates_dir}
+    collections:
+      - "{tmp_path / 'colls'}/*.tar.gz"
+''')
+    wh_path = tmp_path / 'out' / 'content' / 'golden'
+    version_path = os.path.join('v3', 'collections', 'ns', 'coll', 'versions', '1.0.0')
+    _run(config_info)
+
+    old_mtime_ns = 1000000000 * 1000000000
+    for edit, template_name, expected in ((1, 'README.html.j2', {os.path.join(version_path, 'README.html')}),
+                                          (2, 'collection_version.html.j2', {os.path.join(version_path, 'index.html')}),
+                                          (3, 'README.html.j2', {os.path.join(version_path, 'README.html')})):
+        for dir_path, _dirs, filenames in os.walk(tmp_path / 'out'):
+            for filename in filenames:
+                os.utime(os.path.join(dir_path, filename), ns=(old_mtime_ns, old_mtime_ns))
+
+        (templates_dir / template_name).write_text(f'edit {edit}\n')
+        _run(config_info)
+
+        # the page and the sums that cover it, nothing else
+        written = _written_since(tmp_path / 'out', old_mtime_ns)
+        assert {path for path in written if not path.endswith('SHA256SUMS')} == \
+            {os.path.join('content', 'golden', path) for path in expected}
+        for path in expected:
+            assert (wh_path / path).read_text() == f'edit {edit}'
+        _check_sums(wh_path)
+
+
+def test_incremental_insert_lists_files_like_a_full_build(tmp_path):
+    def config_info(path, incremental):
+        path.mkdir()
+        return _config_info(path, f'''    import_mode: metadata
+    incremental: {incremental}
+    collections:
+      - "{tmp_path / 'colls'}/*.tar.gz"
+''')
+
+    (tmp_path / 'colls').mkdir()
+    for version in ('1.0.0', '2.0.0'):
+        _metadata_artifact(tmp_path / 'colls' / f'ns-coll-{version}.tar.gz', version=version)
+    incremental_config_info = config_info(tmp_path / 'incremental', 'true')
+    _run(incremental_config_info)
+
+    # between the versions already there
+    _metadata_artifact(tmp_path / 'colls' / 'ns-coll-1.5.0.tar.gz', version='1.5.0')
+    _run(incremental_config_info)
+    _run(config_info(tmp_path / 'full', 'false'))
+
+    for list_path in ('FILES.txt', 'FILES_NO_ARTIFACTS.txt', os.path.join('content', 'golden', 'FILES.txt')):
+        incremental_list = (tmp_path / 'incremental' / 'out' / list_path).read_text()
+        assert '1.5.0' in incremental_list
+        assert incremental_list == (tmp_path / 'full' / 'out' / list_path).read_text(), list_path
@@ -0,0 +1,67 @@
+import io
+import json
+import logging
+import os.path
+import tarfile
+
+import pytest
+
+from coleslaw import archive
+from coleslaw import utils
+
+log = logging.getLogger(__name__)
+
+
+def _add_member(tar, name, data):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+@pytest.fixture
+def artifact_path(tmp_path):
+    manifest = {'collection_info': {'namespace': 'ns', 'name': 'coll', 'version': '1.0.0'},
+                'file_manifest_file': {'name': 'FILES.json'}}
+    path = tmp_path / 'ns-coll-1.0.0.tar.gz'
+    with tarfile.open(path, mode='w:gz') as tar:
+        _add_member(tar, 'MANIFEST.json', json.dumps(manifest).encode('utf-8'))
+        _add_member(tar, 'FILES.json', b'{"files": []}')
+        _add_member(tar, 'README.md', b'# ns.coll')
+        _add_member(tar, 'plugins/modules/thing.py', b'# a module')
+        _add_member(tar, 'tests/sanity/ignore-2.10.txt', b'')
+    return path
+
+
+def test_read_artifact(artifact_path):
+    contents = archive.read_artifact(artifact_path)
+
+    assert contents.artifact_info.filename == 'ns-coll-1.0.0.tar.gz'
+    assert contents.artifact_info.sha256 == utils.sha256sum_from_path(artifact_path)
+    assert contents.artifact_info.size == os.path.getsize(artifact_path)
+    assert json.loads(contents.b_manifest)['collection_info']['name'] == 'coll'
+    assert contents.file_manifest_filename == 'FILES.json'
+    assert contents.b_file_manifest == b'{"files": []}'
+    assert contents.members['README.md'] == b'# ns.coll'
+
+
+def test_read_artifact_extract(artifact_path, tmp_path):
+    extract_dir = str(tmp_path / 'extract')
+    archive.read_artifact(artifact_path,
+                          extract_dir=extract_dir,
+                          skip_prefixes=archive.import_skip_prefixes({}))
+
+    assert os.path.exists(os.path.join(extract_dir, 'README.md'))
+    assert os.path.exists(os.path.join(extract_dir, 'plugins/modules/thing.py'))
+
+    # read from memory, not written out
+    assert not os.path.exists(os.path.join(extract_dir, 'MANIFEST.json'))
+    assert not os.path.exists(os.path.join(extract_dir, 'FILES.json'))
+
+    # only needed for ansible-test
+    assert not os.path.exists(os.path.join(extract_dir, 'tests'))
+
+
+def test_read_members(artifact_path):
+    members = archive.read_members(artifact_path, ['FILES.json', 'MANIFEST.json', 'missing.txt'])
+    assert sorted(members) == ['FILES.json', 'MANIFEST.json']
+    assert members['FILES.json'] == b'{"files": []}'
@@ -0,0 +1,33 @@
+import os
+
+from coleslaw import cache
+
+
+def test_content_cache_get_put(tmp_path):
+    content_cache = cache.ContentCache(str(tmp_path))
+    key = cache.fingerprint({'some': 'data'})
+
+    assert content_cache.get(key) is None
+
+    content_cache.put(key, {'a': [1, 2, 3]})
+    assert content_cache.get(key) == {'a': [1, 2, 3]}
+
+
+def test_content_cache_evict(tmp_path):
+    content_cache = cache.ContentCache(str(tmp_path), max_size=4096)
+    keys = [cache.fingerprint(i) for i in range(4)]
+
+    for i, key in enumerate(keys):
+        content_cache.put(key, b'x' * 2048)
+        # oldest first
+        os.utime(content_cache._path(key), (i, i))
+
+    removed = content_cache.evict()
+
+    assert removed > 0
+    assert content_cache.get(keys[0]) is None
+    assert content_cache.get(keys[-1]) == b'x' * 2048
+
+
+def test_fingerprint_ignores_dict_order():
+    assert cache.fingerprint({'a': 1, 'b': 2}) == cache.fingerprint({'b': 2, 'a': 1})
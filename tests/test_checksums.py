@@ -0,0 +1,53 @@
+import hashlib
+
+import pytest
+
+from coleslaw import checksums
+from coleslaw import utils
+
+
+@pytest.mark.parametrize("pool_type", checksums.POOL_TYPES)
+def test_checksum_engine(tmp_path, pool_type):
+    paths = []
+    for i in range(4):
+        path = tmp_path / f'file{i}'
+        path.write_text(f'{i}\n')
+        paths.append(str(path))
+    (tmp_path / 'link').symlink_to('file0')
+
+    engine = checksums.ChecksumEngine(workers=2, pool_type=pool_type)
+    try:
+        sha256s = engine.sha256sums(paths + [str(tmp_path / 'link')])
+    finally:
+        engine.close()
+
+    assert [sha256s[path] for path in paths] == [hashlib.sha256(f'{i}\n'.encode()).hexdigest() for i in range(4)]
+    assert sha256s[str(tmp_path / 'link')] == sha256s[paths[0]]
+
+
+def test_checksum_engine_reuses_sums(tmp_path, monkeypatch):
+    path = tmp_path / 'file'
+    path.write_bytes(b'one')
+    engine = checksums.ChecksumEngine(workers=1)
+
+    hashed = []
+
+    def sha256sum_from_path(path):
+        hashed.append(path)
+        return hashlib.sha256(open(path, 'rb').read()).hexdigest()
+
+    monkeypatch.setattr(utils, 'sha256sum_from_path', sha256sum_from_path)
+
+    engine.sha256sums([str(path)])
+    # same file in another SHA256SUMS
+    engine.sha256sums([str(path)])
+    assert len(hashed) == 1
+
+    path.write_bytes(b'changed')
+    assert engine.sha256sums([str(path)])[str(path)] == hashlib.sha256(b'changed').hexdigest()
+    assert len(hashed) == 2
+
+
+def test_checksum_engine_pool_type():
+    with pytest.raises(ValueError):
+        checksums.ChecksumEngine(pool_type='fiber')
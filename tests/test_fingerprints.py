@@ -0,0 +1,49 @@
+import jinja2
+
+from coleslaw import fingerprints
+
+
+def make_env(templates):
+    return jinja2.Environment(loader=jinja2.DictLoader(templates))
+
+
+TEMPLATES = {'base.html.j2': '<html>{% include "navbar.html.j2" %}{% block body %}{% endblock %}</html>',
+             'navbar.html.j2': '<nav></nav>',
+             'sibling_links.html.j2': '{% for sibling in siblings %}{{ sibling }}{% endfor %}',
+             'README.html.j2': '{% extends "base.html.j2" %}{% block body %}readme{% endblock %}',
+             'index.html.j2': '{% extends "base.html.j2" %}{% block body %}'
+                              '{% include "sibling_links.html.j2" %}{% endblock %}',
+             'dynamic.html.j2': '{% include template_var %}'}
+
+
+def test_closure():
+    template_fingerprints = fingerprints.TemplateFingerprints(make_env(TEMPLATES))
+
+    assert template_fingerprints.closure('README.html.j2') == ['README.html.j2', 'base.html.j2', 'navbar.html.j2']
+    assert 'sibling_links.html.j2' in template_fingerprints.closure('index.html.j2')
+    # could include any of them
+    assert template_fingerprints.closure('dynamic.html.j2') == sorted(TEMPLATES)
+    assert template_fingerprints.closure('missing.html.j2') == ['missing.html.j2']
+
+
+def test_changed_templates():
+    previous = fingerprints.TemplateFingerprints(make_env(TEMPLATES)).fingerprints()
+    assert set(previous) == set(TEMPLATES)
+    assert not fingerprints.TemplateFingerprints(make_env(TEMPLATES)).changed_templates(previous)
+
+    templates = dict(TEMPLATES)
+    templates['sibling_links.html.j2'] = 'no links'
+    changed = fingerprints.TemplateFingerprints(make_env(templates)).changed_templates(previous)
+    assert changed == {'sibling_links.html.j2', 'index.html.j2', 'dynamic.html.j2'}
+
+    templates = dict(TEMPLATES)
+    templates['navbar.html.j2'] = '<nav>changed</nav>'
+    del templates['dynamic.html.j2']
+    changed = fingerprints.TemplateFingerprints(make_env(templates)).changed_templates(previous)
+    assert changed == {'navbar.html.j2', 'base.html.j2', 'README.html.j2', 'index.html.j2', 'dynamic.html.j2'}
+
+
+def test_for_env():
+    env = make_env(TEMPLATES)
+    assert fingerprints.for_env(env) is fingerprints.for_env(env)
+    assert fingerprints.for_env(env) is not fingerprints.for_env(make_env(TEMPLATES))
@@ -0,0 +1,48 @@
+import json
+
+from galaxy_importer import loaders
+from galaxy_importer.config import Config
+
+from coleslaw import cache
+from coleslaw import loader
+
+
+def _file_manifest(plugin_sha256):
+    return json.dumps({'files': [
+        {'name': '.', 'ftype': 'dir', 'chksum_type': None, 'chksum_sha256': None},
+        {'name': 'plugins/modules/ping.py', 'ftype': 'file',
+         'chksum_type': 'sha256', 'chksum_sha256': plugin_sha256},
+        {'name': 'plugins/modules/net/pong.py', 'ftype': 'file',
+         'chksum_type': 'sha256', 'chksum_sha256': 'b' * 64},
+    ]}).encode('utf-8')
+
+
+def test_caching_doc_string_loader(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_run_ansible_doc(self, plugin_type, plugins):
+        calls.append(list(plugins))
+        return dict((plugin, {'doc': {'name': plugin}}) for plugin in plugins)
+
+    monkeypatch.setattr(loaders.DocStringLoader, '_run_ansible_doc', fake_run_ansible_doc)
+
+    doc_cache = cache.ContentCache(str(tmp_path))
+    plugins = ['ns.coll.ping', 'ns.coll.net.pong']
+
+    def run(plugin_sha256):
+        doc_loader = loader.CachingDocStringLoader(str(tmp_path), 'ns.coll', Config(),
+                                                   doc_cache=doc_cache,
+                                                   file_sha256s=loader.file_manifest_sha256s(_file_manifest(plugin_sha256)))
+        return doc_loader._run_ansible_doc('module', plugins)
+
+    first = run('a' * 64)
+    assert calls == [plugins]
+    assert set(first) == set(plugins)
+
+    # nothing changed, so no ansible-doc
+    assert run('a' * 64) == first
+    assert len(calls) == 1
+
+    # only the changed plugin is documented again
+    run('c' * 64)
+    assert calls[-1] == ['ns.coll.ping']
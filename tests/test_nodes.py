@@ -6,6 +6,7 @@ import anytree
 
 import pytest
 
+from coleslaw import models
 from coleslaw import nodes
 
 log = logging.getLogger(__name__)
@@ -137,3 +138,269 @@ def test_node_arbitrary_field(Node_Class):
     assert isinstance(node, Node_Class)
 
     assert node.some_field == some_value
+
+
+def test_children_by_name():
+    root = nodes.PathNode("")
+    versions = nodes.PathNode("versions", parent=root)
+    v1 = nodes.PathNode("1.0.0", parent=versions)
+
+    assert root.get_path("versions/1.0.0") is v1
+    assert versions.get_child("2.0.0") is None
+    with pytest.raises(anytree.ChildResolverError):
+        root.get_path("versions/2.0.0")
+
+    # existing child is returned instead of adding a duplicate
+    assert versions.get_or_add_child(nodes.PathNode("1.0.0")) is v1
+
+    v1.name = "1.0.1"
+    assert versions.get_child("1.0.0") is None
+    assert versions.get_child("1.0.1") is v1
+
+    v1.parent = None
+    assert versions.get_child("1.0.1") is None
+
+    # the index is runtime only
+    assert "_excluded_children_by_name" not in versions.asdict()
+    assert versions.asdict()["name"] == "versions"
+
+
+def test_cached_paths_invalidated():
+    root = nodes.PathNode("", fs_prefix="/srv/out", url_prefix="prefix")
+    other_root = nodes.PathNode("", fs_prefix="/srv/other", url_prefix="other")
+    content = nodes.PathNode("content", parent=root)
+    wh = nodes.PathNode("wh", parent=content)
+    index = nodes.IndexJsonNode("index.json", parent=wh)
+
+    assert index.fs_pth == "/srv/out/content/wh/index.json"
+    assert wh.url_pth == "prefix/content/wh/"
+
+    content.parent = other_root
+    assert index.fs_pth == "/srv/other/content/wh/index.json"
+    assert index.url_pth == "other/content/wh/index.json"
+
+    wh.name = "renamed"
+    assert index.pth == "/content/renamed/index.json"
+    assert index.fs_pth == "/srv/other/content/renamed/index.json"
+
+    assert "_excluded_fs_pth" not in index.asdict()
+
+
+def test_node_dict_only_has_exported_fields():
+    from coleslaw import snapshot
+
+    root = nodes.PathNode("", fs_prefix="/srv/out")
+    version = nodes.PathNode("1.0.0", parent=root, version="1.0.0")
+    leaf = nodes.IndexHtmlNode("index.html", parent=version, template_name="collection_version.html.j2")
+    leaf.fs_pth
+    root.get_child("1.0.0")
+
+    assert leaf.children == ()
+    assert sorted(leaf.__dict__) == ['_node_type', 'name', 'template_name']
+
+    loaded = snapshot.snapshot_loads(snapshot.snapshot_dumps(root))
+    loaded_leaf = loaded.get_path("1.0.0/index.html")
+    assert isinstance(loaded_leaf, nodes.IndexHtmlNode)
+    assert loaded_leaf.template_name == "collection_version.html.j2"
+    assert loaded.get_child("1.0.0").version == "1.0.0"
+
+
+def test_versions_index():
+    versions = nodes.PathNode("versions")
+    index = nodes.VersionsIndexJsonNode("index.json", parent=versions)
+    for version in ("1.10.0", "1.2.0", "2.0.0-beta.1", "1.9.0"):
+        nodes.PathNode(version, parent=versions, version=version)
+    nodes.PathNode("not_a_version", parent=versions)
+
+    assert [node.name for node in versions.version_nodes()] == ["1.2.0", "1.9.0", "1.10.0", "2.0.0-beta.1"]
+    assert nodes.highest_version_node(versions).name == "2.0.0-beta.1"
+
+    # same order compare_nodes gives
+    assert index.index_of() == sorted(node for node in versions.children if node.is_version_node())
+
+    versions.get_child("2.0.0-beta.1").parent = None
+    assert nodes.highest_version_node(versions).name == "1.10.0"
+    assert [node.name for node in index.index_of()] == ["1.10.0", "1.9.0", "1.2.0"]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sort_key_matches_compare_nodes(seed):
+    import random
+
+    versions = nodes.PathNode("versions")
+    children = [nodes.HighestVersionFsSymlinkNode("default", parent=versions),
+                nodes.VersionsIndexJsonNode("index.json", parent=versions),
+                nodes.IndexJsonNode("SNAPSHOT.json", parent=versions),
+                nodes.IndexSha256sumNode("SHA256SUMS", parent=versions)]
+    for version in ("1.10.0", "1.2.0", "2.0.0-beta.1", "2.0.0", "1.9.0", "0.0.1-alpha"):
+        children.append(nodes.PathNode(version, parent=versions, version=version))
+
+    namespace = nodes.PathNode("ns")
+    children.extend([nodes.IndexHtmlNode("index.html", parent=namespace),
+                     nodes.IndexBytesNode("MANIFEST.json", parent=namespace),
+                     nodes.IndexArtifactNode("ns-b-1.0.0.tar.gz", parent=namespace),
+                     nodes.PathNode("b", parent=namespace),
+                     nodes.PathNode("a", parent=namespace),
+                     nodes.PathNode("default", parent=namespace)])
+
+    for parent in (versions, namespace):
+        siblings = list(parent.children)
+        random.Random(seed).shuffle(siblings)
+        assert sorted(siblings, key=nodes.by_sort_key) == sorted(siblings)
+
+    assert [node.name for node in sorted(versions.children, key=nodes.by_sort_key)][:3] == \
+        ["default", "2.0.0", "2.0.0-beta.1"]
+
+
+def test_warehouse_indexes():
+    from coleslaw import snapshot
+
+    content = nodes.PathNode("content")
+    wh = nodes.PathNode("wh", parent=content, warehouse_name="wh")
+    artifacts = nodes.PathNode("artifacts", parent=wh)
+    name_node = nodes.PathNode("name", parent=nodes.PathNode("ns", parent=wh), collection_label="ns.name")
+    version = nodes.PathNode("1.0.0", parent=nodes.PathNode("versions", parent=name_node),
+                             namespace="ns", collection="name", collection_label="ns.name", version="1.0.0")
+    artifact = nodes.IndexArtifactNode("ns-name-1.0.0.tar.gz", parent=artifacts)
+    nodes.IndexArtifactNode("elsewhere.tar.gz", parent=wh)
+
+    assert wh.find_collection("ns.name") is name_node
+    assert version.find_version("ns", "name", "1.0.0") is version
+    assert artifacts.find_by_type("IndexArtifactNode") == (artifact,)
+    assert set(wh.find_by_type("IndexArtifactNode")) == \
+        set(wh.findall(filter_=wh.filter_by_attr("_node_type", "IndexArtifactNode")))
+    assert content.find_warehouses() == (wh,)
+
+    # a subtree moved out of the warehouse is no longer indexed
+    name_node.parent.parent = None
+    assert wh.find_collection("ns.name") is None
+    assert wh.find_version("ns", "name", "1.0.0") is None
+
+    loaded = snapshot.snapshot_loads(snapshot.snapshot_dumps(wh))
+    assert loaded.find_by_type("IndexArtifactNode")[0].name == "ns-name-1.0.0.tar.gz"
+    assert "_excluded_warehouse_indexes" not in loaded.asdict()
+
+
+def test_collection_version_virtual_children():
+    from coleslaw import snapshot
+
+    versions = nodes.PathNode("versions", fs_prefix="/srv/out")
+    docs_blob = {'collection_readme': {'name': 'README.md', 'html': '<h1>hi</h1>'},
+                 'documentation_files': [], 'contents': [], 'execution_environment': {}}
+    collection_data = models.CollectionVersionData(metadata={'name': 'coll'}, docs_blob=docs_blob,
+                                                   artifact={'size': 10}, file_manifest_filename='FILES.json',
+                                                   b_manifest=b'{}')
+    version = nodes.CollectionVersionNode("1.0.0", parent=versions, collection_data=collection_data,
+                                          download_url='http://example/a.tar.gz',
+                                          namespace='ns', collection='coll', version='1.0.0')
+
+    assert [child.name for child in version.children] == \
+        ['index.json', 'README.html', 'index.html', 'docs_blob', 'MANIFEST.json', 'FILES.json']
+    readme = version.get_child('README.html')
+    assert readme.body_html == '<h1>hi</h1>'
+    assert readme.parent is version
+    assert readme.pth == "versions/1.0.0/README.html"
+    assert version.get_path('docs_blob/index.json').collection_readme['name'] == 'README.md'
+    # the leaves share the version data instead of copying it
+    assert version.get_child('index.json').metadata is collection_data.metadata
+    assert version.get_path('docs_blob/index.html').docs_blob is docs_blob
+    assert version.get_child('MANIFEST.json').b_filecontents == b'{}'
+    assert version.artifact_info['size'] == 10
+
+    # built once, until released
+    assert version.get_child('README.html') is readme
+    versions.release()
+    assert version.get_child('README.html') is not readme
+
+    # the tree and the snapshot only have the version node
+    assert versions._real_children() == [version]
+    loaded = snapshot.snapshot_loads(snapshot.snapshot_dumps(versions))
+    snapshot_data = snapshot.snapshot_dumps(versions)
+    assert 'README.html' not in snapshot_data
+    assert snapshot_data.count('collection_readme') == 1
+    assert loaded.get_path('1.0.0/docs_blob/index.html').docs_blob == docs_blob
+    assert loaded.get_child('1.0.0').metadata == {'name': 'coll'}
+
+
+def test_dirty_propagation():
+    wh = nodes.PathNode("wh", warehouse_name="wh")
+    sums = nodes.IndexSha256sumNode("SHA256SUMS", parent=wh, _recursive=True)
+    name_node = nodes.PathNode("name", parent=nodes.PathNode("ns", parent=wh))
+    collection_index = nodes.CollectionIndexJsonNode("index.json", parent=name_node)
+    versions = nodes.PathNode("versions", parent=name_node)
+    versions_index = nodes.VersionsIndexJsonNode("index.json", parent=versions)
+    nodes.PathNode("1.0.0", parent=versions, version="1.0.0")
+    other = nodes.PathNode("other", parent=nodes.PathNode("otherns", parent=wh))
+    other_index = nodes.ListIndexJsonNode("index.json", parent=other)
+
+    assert wh.needs_export
+    wh.mark_clean()
+    assert not wh.needs_export
+    assert not sums.is_dirty
+
+    nodes.PathNode("1.1.0", parent=versions, version="1.1.0")
+    # the nodes that read the new version, and the directories above it
+    assert versions_index.is_dirty
+    assert collection_index.is_dirty
+    assert sums.is_dirty
+    assert wh.needs_export and name_node.needs_export and not name_node.is_dirty
+    # nothing else
+    assert not other_index.is_dirty
+    assert not other.needs_export
+
+    other_index.changed()
+    assert other_index.is_dirty and other.needs_export
+
+
+def test_highest_version_symlink_follows_new_versions(tmp_path):
+    root = nodes.PathNode("", fs_prefix=str(tmp_path))
+    versions = nodes.PathNode("versions", parent=root)
+    link = nodes.HighestVersionFsSymlinkNode("default", parent=versions, _target_is_directory=True)
+    for version in ("1.0.0", "1.1.0"):
+        nodes.PathNode(version, parent=versions, version=version)
+    os.makedirs(versions.fs_pth)
+
+    link.save()
+    assert os.readlink(link.fs_pth) == "1.1.0"
+
+    nodes.PathNode("1.2.0", parent=versions, version="1.2.0")
+    link.save()
+    assert os.readlink(link.fs_pth) == "1.2.0"
+
+
+def test_mark_templates_changed():
+    wh = nodes.PathNode("wh", warehouse_name="wh")
+    sums = nodes.IndexSha256sumNode("SHA256SUMS", parent=wh, _recursive=True)
+    versions = nodes.PathNode("versions", parent=wh)
+    versions_html = nodes.IndexHtmlNode("index.html", parent=versions, template_name="collection_versions.html.j2")
+    collection_data = models.CollectionVersionData(docs_blob={'collection_readme': {'html': ''}})
+    version = nodes.CollectionVersionNode("1.0.0", parent=versions, collection_data=collection_data,
+                                          download_url='http://example/a.tar.gz',
+                                          namespace='ns', collection='coll', version='1.0.0')
+    other_version = nodes.CollectionVersionNode("1.1.0", parent=versions, collection_data=collection_data,
+                                                download_url='http://example/b.tar.gz',
+                                                namespace='ns', collection='coll', version='1.1.0')
+    wh.mark_clean()
+
+    wh.mark_templates_changed({'README.html.j2'})
+    assert version.get_child('README.html').is_dirty
+    assert version.get_child('README.html').needs_export
+    # only the pages using the template, not the rest of the version
+    assert not version.is_dirty and version.needs_export
+    assert not version.get_child('index.html').is_dirty
+    assert not version.get_child('index.json').is_dirty
+    assert not versions_html.is_dirty
+    assert sums.is_dirty
+
+    # kept by the version node, so still dirty when the virtual children are built again
+    versions.release()
+    assert version.get_child('README.html').is_dirty
+    assert other_version.get_child('README.html').is_dirty
+    version.mark_saved()
+    assert not version.get_child('README.html').is_dirty and not version.needs_export
+
+    wh.mark_templates_changed({'collection_version_docs_blob.html.j2'})
+    docs_blob = version.get_child('docs_blob')
+    assert docs_blob.get_child('index.html').is_dirty
+    assert docs_blob.needs_export and not docs_blob.is_dirty
+    assert not docs_blob.get_child('index.json').is_dirty
@@ -0,0 +1,197 @@
+import shutil
+import time
+
+import pytest
+
+from coleslaw import models
+from coleslaw import readers
+from coleslaw import workers
+
+
+def _warehouse_info(name, **kwargs):
+    return models.WarehouseInfo(warehouse_name=name,
+                                district_dir='./output/',
+                                server=models.ServerInfo(),
+                                **kwargs)
+
+
+def test_plan_import_jobs(tmp_path):
+    artifact_path = tmp_path / 'ns-coll-1.0.0.tar.gz'
+    artifact_path.write_bytes(b'some artifact')
+    copy_dir = tmp_path / 'copy'
+    copy_dir.mkdir()
+    copy_path = copy_dir / 'ns-coll-1.0.0.tar.gz'
+    shutil.copy(artifact_path, copy_path)
+    other_path = tmp_path / 'ns-coll-2.0.0.tar.gz'
+    other_path.write_bytes(b'other artifact')
+
+    golden = _warehouse_info('golden')
+    silver = _warehouse_info('silver')
+    bronze = _warehouse_info('bronze', import_mode='metadata')
+
+    import_jobs = readers.plan_import_jobs([(golden, [artifact_path, other_path]),
+                                            (silver, [copy_path]),
+                                            (bronze, [artifact_path])])
+
+    destinations = sorted(sorted(job.destinations) for job in import_jobs)
+
+    # same contents and import config is imported once, a different import_mode is not
+    assert destinations == [[('bronze', artifact_path)],
+                            [('golden', artifact_path), ('silver', copy_path)],
+                            [('golden', other_path)]]
+
+
+def test_plan_import_jobs_hashes_on_checksum_engine(tmp_path):
+    from coleslaw import checksums
+
+    class RecordingEngine(checksums.ChecksumEngine):
+        calls = []
+
+        def sha256sums(self, paths):
+            paths = list(paths)
+            self.calls.append(sorted(paths))
+            return super().sha256sums(paths)
+
+    artifact_path = tmp_path / 'ns-coll-1.0.0.tar.gz'
+    artifact_path.write_bytes(b'some artifact')
+    same_size_path = tmp_path / 'ns-coll-1.0.1.tar.gz'
+    same_size_path.write_bytes(b'sane artifact')
+    other_path = tmp_path / 'ns-coll-2.0.0.tar.gz'
+    other_path.write_bytes(b'a bigger artifact')
+
+    checksum_engine = RecordingEngine(workers=2)
+    try:
+        import_jobs = readers.plan_import_jobs([(_warehouse_info('golden'),
+                                                 [artifact_path, same_size_path, other_path])],
+                                               checksum_engine=checksum_engine)
+    finally:
+        checksum_engine.close()
+
+    assert len(import_jobs) == 3
+    # only the artifacts that might be the same are hashed, all at once
+    assert checksum_engine.calls == [sorted([artifact_path.resolve(), same_size_path.resolve()])]
+
+
+def _fake_import_collection(collection_path, warehouse_info, importer_info):
+    if 'slow' in collection_path.name:
+        time.sleep(30)
+    if 'bad' in collection_path.name:
+        raise ValueError('not a collection')
+    return collection_path.name
+
+
+def test_run_import_jobs_failures(tmp_path, monkeypatch):
+    monkeypatch.setattr(readers, 'import_collection', _fake_import_collection)
+
+    warehouse_info = _warehouse_info('golden')
+    import_jobs = [models.ImportJob(collection_path=tmp_path / name, warehouse_info=warehouse_info)
+                   for name in ('ns-slow-1.0.0.tar.gz', 'ns-bad-1.0.0.tar.gz', 'ns-good-1.0.0.tar.gz')]
+    importer_info = models.ImporterInfo(workers=2, start_method='fork', timeout=0.5, retries=1)
+
+    with workers.import_pool(importer_info) as pool:
+        results = dict((import_job.collection_path.name, result)
+                       for import_job, result in readers.run_import_jobs(pool, import_jobs, importer_info))
+
+    assert results['ns-good-1.0.0.tar.gz'] == 'ns-good-1.0.0.tar.gz'
+
+    assert isinstance(results['ns-bad-1.0.0.tar.gz'], models.ImportFailure)
+    assert 'ValueError' in results['ns-bad-1.0.0.tar.gz'].reason
+    assert results['ns-bad-1.0.0.tar.gz'].attempts == 2
+
+    assert 'ImportTimeout' in results['ns-slow-1.0.0.tar.gz'].reason
+
+
+def test_import_collections_without_jobs(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError('an import pool was started')
+
+    monkeypatch.setattr(workers, 'import_pool', no_pool)
+    assert list(readers.import_collections([(_warehouse_info('golden'), [])], models.ImporterInfo())) == []
+
+
+def test_import_pool_configs_only_for_importing_warehouses(tmp_path, monkeypatch):
+    artifact_path = tmp_path / 'ns-coll-1.0.0.tar.gz'
+    artifact_path.write_bytes(b'some artifact')
+    pool_configs = []
+
+    class PoolStarted(Exception):
+        pass
+
+    def recording_import_pool(importer_info, galaxy_importer_configs=None):
+        pool_configs.extend(galaxy_importer_configs)
+        raise PoolStarted()
+
+    monkeypatch.setattr(workers, 'import_pool', recording_import_pool)
+    import_requests = [(_warehouse_info('golden', galaxy_importer_config={'run_ansible_doc': True}), [artifact_path]),
+                       (_warehouse_info('silver', galaxy_importer_config={'run_flake8': True}), []),
+                       (_warehouse_info('bronze', galaxy_importer_config={'run_ansible_test': True},
+                                        import_mode='metadata'), [artifact_path])]
+    with pytest.raises(PoolStarted):
+        list(readers.import_collections(import_requests, models.ImporterInfo()))
+
+    # silver has nothing to import and bronze does not run galaxy_importer
+    assert pool_configs == [{'run_ansible_doc': True}]
+
+
+def _metadata_artifact(path, version='1.0.0'):
+    import io
+    import json
+    import tarfile
+
+    manifest = {'collection_info': {'namespace': 'ns', 'name': 'coll', 'version': version, 'readme': 'README.md',
+                                    'authors': ['someone'], 'license': ['GPL-3.0-or-later'], 'description': 'x',
+                                    'tags': [], 'repository': 'http://example.com/repo'},
+                'file_manifest_file': {'name': 'FILES.json'}}
+    with tarfile.open(path, mode='w:gz') as tar:
+        for name, data in (('MANIFEST.json', json.dumps(manifest).encode('utf-8')),
+                           ('FILES.json', b'{"files": []}'),
+                           ('README.md', b'# ns.coll')):
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tar.addfile(tarinfo, io.BytesIO(data))
+    return path
+
+
+def test_import_collection_reads_artifact_once(tmp_path, monkeypatch):
+    from coleslaw import archive
+    from coleslaw import loader
+    from coleslaw import utils
+
+    artifact_path = _metadata_artifact(tmp_path / 'ns-coll-1.0.0.tar.gz')
+    copy_dir = tmp_path / 'copy'
+    copy_dir.mkdir()
+    copy_path = copy_dir / 'ns-coll-1.0.0.tar.gz'
+    shutil.copy(artifact_path, copy_path)
+
+    warehouse_info = _warehouse_info('golden', import_mode='metadata')
+    importer_info = models.ImporterInfo(cache_dir=str(tmp_path / 'cache'))
+
+    reads = []
+    read_artifact = archive.read_artifact
+
+    def counting_read_artifact(collection_path, *args, **kwargs):
+        reads.append(collection_path)
+        return read_artifact(collection_path, *args, **kwargs)
+
+    def no_sha256sum(path):
+        raise AssertionError(f'{path} was read just to hash it')
+
+    monkeypatch.setattr(archive, 'read_artifact', counting_read_artifact)
+    monkeypatch.setattr(utils, 'sha256sum_from_path', no_sha256sum)
+
+    loader_result = readers.import_collection(artifact_path, warehouse_info, importer_info)
+    assert reads == [artifact_path]
+
+    # the same contents at a new path is read once, for its sha256, and not loaded again
+    def no_load(*args, **kwargs):
+        raise AssertionError('loaded again')
+
+    monkeypatch.setattr(loader, 'parse_manifest', no_load)
+    copy_result = readers.import_collection(copy_path, warehouse_info, importer_info)
+    assert reads == [artifact_path, copy_path]
+    assert copy_result.artifact_info.full_path == copy_path
+    assert copy_result.artifact_info.sha256 == loader_result.artifact_info.sha256
+
+    # unchanged since it was last seen, so not read at all
+    readers.import_collection(artifact_path, warehouse_info, importer_info)
+    assert reads == [artifact_path, copy_path]
@@ -0,0 +1,13 @@
+import hashlib
+
+import pytest
+
+from coleslaw import utils
+
+
+@pytest.mark.parametrize("size", [0, 1, utils.HASH_BLOCK_SIZE + 1])
+def test_sha256sum_from_path(tmp_path, size):
+    b_contents = bytes(range(256)) * (size // 256) + b'x' * (size % 256)
+    path = tmp_path / 'file'
+    path.write_bytes(b_contents)
+    assert utils.sha256sum_from_path(str(path)) == hashlib.sha256(b_contents).hexdigest()
@@ -0,0 +1,35 @@
+from coleslaw import models
+from coleslaw import workers
+
+
+def test_importer_config_built_once():
+    config_data = {'run_ansible_doc': False}
+
+    cfg = workers.importer_config(config_data)
+
+    assert cfg.run_ansible_doc is False
+    assert workers.importer_config({'run_ansible_doc': False}) is cfg
+    assert workers.importer_config({'run_ansible_doc': True}) is not cfg
+
+
+def test_importer_info_pool_settings():
+    importer_info = models.ImporterInfo.from_dict({'import_workers': 4,
+                                                   'import_start_method': 'spawn',
+                                                   'import_maxtasksperchild': 10})
+
+    assert importer_info.workers == 4
+    assert importer_info.start_method == 'spawn'
+    assert importer_info.maxtasksperchild == 10
+    assert importer_info.chunksize == 1
+
+
+def test_importer_configs_skip_metadata_warehouses():
+    def warehouse_info(name, **kwargs):
+        return models.WarehouseInfo(warehouse_name=name, district_dir='./output/', server=models.ServerInfo(), **kwargs)
+
+    configs = workers.importer_configs([warehouse_info('golden', galaxy_importer_config={'run_ansible_doc': True}),
+                                        warehouse_info('silver', galaxy_importer_config={'run_ansible_doc': True}),
+                                        warehouse_info('bronze', galaxy_importer_config={'run_flake8': True},
+                                                       import_mode='metadata')])
+
+    assert configs == [{'run_ansible_doc': True}]
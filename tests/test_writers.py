@@ -0,0 +1,238 @@
+import concurrent.futures
+import hashlib
+import os.path
+
+import pytest
+
+from coleslaw import archive
+from coleslaw import nodes
+from coleslaw import snapshot
+from coleslaw import writers
+
+
+def test_export_now(tmp_path):
+    root = nodes.PathNode(str(tmp_path))
+    versions = nodes.PathNode("versions", parent=root)
+    version = nodes.PathNode("1.0.0", parent=versions)
+    index = nodes.IndexBytesNode("MANIFEST.json", parent=version, b_filecontents=b'{}')
+
+    writers.TreeExport(version).export_now()
+    assert os.path.exists(index.fs_pth)
+    assert writers.is_exported(version)
+
+    # already written subtrees are skipped by the full export
+    os.unlink(index.fs_pth)
+    writers.TreeExport(root).export()
+    assert not os.path.exists(index.fs_pth)
+
+    # but the marker is never persisted
+    assert writers.EXPORTED_ATTR not in snapshot.snapshot_dumps(root)
+
+
+def test_released_bytes_are_reloaded(tmp_path):
+    import io
+    import tarfile
+
+    from coleslaw import models
+
+    b_manifest = b'{"collection_info": {}}'
+    artifact_path = tmp_path / 'ns-coll-1.0.0.tar.gz'
+    with tarfile.open(artifact_path, mode='w:gz') as tar:
+        tarinfo = tarfile.TarInfo('MANIFEST.json')
+        tarinfo.size = len(b_manifest)
+        tar.addfile(tarinfo, io.BytesIO(b_manifest))
+
+    root = nodes.PathNode(str(tmp_path / 'out'))
+    collection_data = models.CollectionVersionData(docs_blob={'collection_readme': {'html': ''}},
+                                                   artifact={'full_path': str(artifact_path)},
+                                                   file_manifest_filename='FILES.json',
+                                                   manifest_sha256=models.CollectionVersionData._sha256(b_manifest),
+                                                   b_manifest=b_manifest)
+    version = nodes.CollectionVersionNode("1.0.0", parent=root, collection_data=collection_data,
+                                          download_url='', namespace='ns', collection='coll', version='1.0.0')
+    version.release()
+    assert version.collection_data.b_manifest is None
+
+    manifest = version.get_child('MANIFEST.json')
+    os.makedirs(version.fs_pth)
+    manifest.reserve()
+    manifest.save()
+    with open(manifest.fs_pth, 'rb') as manifest_fo:
+        assert manifest_fo.read() == b_manifest
+
+    # the new MANIFEST.json node built after a release still knows what was saved
+    version.release()
+    assert version.get_child('MANIFEST.json') is not manifest
+    assert version.get_child('MANIFEST.json').saved_sha256() == collection_data.manifest_sha256
+    manifest = version.get_child('MANIFEST.json')
+
+    # the file is already right, so the artifact is not read again
+    os.unlink(artifact_path)
+    manifest.reserve()
+    manifest.save()
+    assert manifest.is_current()
+
+
+def test_sha256sums_use_saved_sha256(tmp_path, monkeypatch):
+    from coleslaw import utils
+
+    root = nodes.PathNode(str(tmp_path))
+    nodes.IndexNode("README.txt", parent=root, data='hello\n')
+    nodes.IndexBytesNode("MANIFEST.json", parent=root, b_filecontents=b'{}')
+    sums = nodes.IndexSha256sumNode("SHA256SUMS", parent=root)
+    writers.TreeExport(root).export()
+
+    def no_reads(path):
+        raise AssertionError(f'{path} was read again')
+
+    monkeypatch.setattr(utils, 'sha256sum_from_path', no_reads)
+    readme_sha256 = hashlib.sha256(b'hello\n').hexdigest()
+    manifest_sha256 = hashlib.sha256(b'{}').hexdigest()
+    assert sums.body().splitlines() == [f'{manifest_sha256}  MANIFEST.json',
+                                        f'{readme_sha256}  README.txt']
+
+
+def test_export_saves_aggregates_after_their_files(tmp_path, monkeypatch):
+    root = nodes.PathNode(str(tmp_path / 'out'))
+    # declared before the files they list, like the real trees
+    sums = nodes.IndexSha256sumNode("SHA256SUMS", parent=root, _recursive=True)
+    file_list = nodes.IndexFileListNode("FILES.txt", parent=root, _recursive=True)
+    subdir = nodes.PathNode("sub", parent=root)
+    nodes.IndexNode("README.txt", parent=subdir, data='hello\n')
+
+    def no_reserve(self):
+        raise AssertionError(f'{self} was reserved')
+
+    monkeypatch.setattr(nodes.IndexNode, 'reserve', no_reserve)
+    assert [node.name for node in writers.export_order(root)] == [root.name, 'sub', 'README.txt',
+                                                                  'FILES.txt', 'SHA256SUMS']
+    writers.TreeExport(root).export()
+
+    with open(file_list.fs_pth) as file_list_fo:
+        assert file_list_fo.read().splitlines() == ['sub/README.txt', 'FILES.txt', 'SHA256SUMS']
+    with open(sums.fs_pth) as sums_fo:
+        lines = sums_fo.read().splitlines()
+    assert [line.split()[1] for line in lines] == ['sub/README.txt', 'FILES.txt']
+    assert lines[0].split()[0] == hashlib.sha256(b'hello\n').hexdigest()
+
+
+def test_export_skips_unchanged_files(tmp_path):
+    artifact_path = tmp_path / 'ns-coll-1.0.0.tar.gz'
+    artifact_path.write_bytes(b'not really a tarball')
+    artifact_info = archive.artifact_info_from_stat(artifact_path, hashlib.sha256(b'not really a tarball').hexdigest(),
+                                                    os.stat(artifact_path))
+
+    root = nodes.PathNode(str(tmp_path / 'out'))
+    index = nodes.IndexNode("index.html", parent=root, data='hello\n')
+    manifest = nodes.IndexBytesNode("MANIFEST.json", parent=root, b_filecontents=b'{}')
+    artifact = nodes.IndexArtifactNode(artifact_info.filename, parent=root,
+                                       collection_filename=artifact_info.full_path,
+                                       file_size=artifact_info.size,
+                                       mtime=artifact_info.mtime,
+                                       sha256=artifact_info.sha256)
+    writers.TreeExport(root).export()
+
+    old_mtime_ns = 10 ** 18
+    for node in (index, manifest, artifact):
+        os.utime(node.fs_pth, ns=(old_mtime_ns, old_mtime_ns))
+
+    writers.TreeExport(root).export()
+    for node in (index, manifest, artifact):
+        assert os.stat(node.fs_pth).st_mtime_ns == old_mtime_ns
+
+    index.data = 'changed\n'
+    index.changed()
+    writers.TreeExport(root).export()
+    assert os.stat(index.fs_pth).st_mtime_ns != old_mtime_ns
+    with open(index.fs_pth) as index_fo:
+        assert index_fo.read() == 'changed\n'
+
+
+@pytest.mark.parametrize("pool_type", ['thread', 'process'])
+def test_export_on_pool(tmp_path, monkeypatch, pool_type):
+    from coleslaw import utils
+
+    def make_tree(path):
+        root = nodes.PathNode(str(path))
+        nodes.IndexSha256sumNode("SHA256SUMS", parent=root, _recursive=True)
+        nodes.IndexFileListNode("FILES.txt", parent=root, _recursive=True)
+        for dir_number in range(4):
+            subdir = nodes.PathNode(f"dir{dir_number}", parent=root)
+            nodes.IndexSha256sumNode("SHA256SUMS", parent=subdir)
+            for file_number in range(5):
+                nodes.IndexNode(f"file{file_number}.txt", parent=subdir, data=f'{dir_number} {file_number}\n')
+            nodes.IndexBytesNode("MANIFEST.json", parent=subdir, b_filecontents=b'{}')
+        return root
+
+    monkeypatch.setattr(writers, 'EXPORT_BATCH_SIZE', 3)
+    writers.TreeExport(make_tree(tmp_path / 'serial')).export()
+    root = make_tree(tmp_path / 'pool')
+    writers.TreeExport(root, workers=4, pool_type=pool_type).export()
+
+    for dir_path, _dirs, filenames in os.walk(tmp_path / 'serial'):
+        for filename in filenames:
+            serial_path = os.path.join(dir_path, filename)
+            pool_path = os.path.join(tmp_path / 'pool', os.path.relpath(serial_path, tmp_path / 'serial'))
+            with open(serial_path, 'rb') as serial_fo, open(pool_path, 'rb') as pool_fo:
+                assert serial_fo.read() == pool_fo.read()
+
+    # the sums saved by the workers were passed back, so nothing is read again
+    def no_reads(path):
+        raise AssertionError(f'{path} was read again')
+
+    monkeypatch.setattr(utils, 'sha256sum_from_path', no_reads)
+    assert root.get_path('dir0/file0.txt').saved_sha256() == hashlib.sha256(b'0 0\n').hexdigest()
+    root.get_child('SHA256SUMS').body()
+    assert not root.needs_export
+
+
+def test_export_pool_type():
+    with pytest.raises(ValueError):
+        writers.TreeExport(nodes.PathNode('/tmp'), workers=2, pool_type='fiber')
+    with pytest.raises(ValueError):
+        writers.check_app_config({'export_pool': 'fiber'})
+    # forked export workers and warehouse threads do not mix
+    with pytest.raises(ValueError):
+        writers.check_app_config({'export_workers': 2, 'parallel_warehouses': 2})
+    writers.check_app_config({'export_workers': 2, 'export_pool': 'thread', 'parallel_warehouses': 2})
+    writers.check_app_config({'export_workers': 1, 'parallel_warehouses': 2})
+
+
+def test_export_pool_not_forked_with_other_threads():
+    import threading
+
+    tree_export = writers.TreeExport(nodes.PathNode('/tmp'), workers=2, pool_type='process')
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+    try:
+        with tree_export._executor() as executor:
+            assert isinstance(executor, concurrent.futures.ThreadPoolExecutor)
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_aggregates_save_missing_clean_files_again(tmp_path):
+    root = nodes.PathNode(str(tmp_path), warehouse_name='wh')
+    sums = nodes.IndexSha256sumNode("SHA256SUMS", parent=root, _recursive=True)
+    file_list = nodes.IndexFileListNode("FILES.txt", parent=root, _recursive=True)
+    subdir = nodes.PathNode("sub", parent=root)
+    readme = nodes.IndexNode("README.txt", parent=subdir, data='hello\n')
+    writers.TreeExport(root).export()
+    with open(sums.fs_pth) as sums_fo:
+        sums_data = sums_fo.read()
+
+    root.mark_clean()
+    os.unlink(readme.fs_pth)
+    os.rmdir(subdir.fs_pth)
+    sums.changed()
+    file_list.changed()
+    writers.TreeExport(root).export()
+
+    with open(readme.fs_pth) as readme_fo:
+        assert readme_fo.read() == 'hello\n'
+    with open(sums.fs_pth) as sums_fo:
+        assert sums_fo.read() == sums_data
+    with open(file_list.fs_pth) as file_list_fo:
+        assert 'sub' not in file_list_fo.read().splitlines()